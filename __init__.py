@@ -3,6 +3,7 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import carrier
+from . import ir
 from . import stock
 from . import sale
 
@@ -11,7 +12,13 @@ def register():
     Pool.register(
         carrier.Carrier,
         carrier.FormulaPriceList,
+        carrier.FormulaPriceListTier,
         stock.ShipmentIn,
         stock.ShipmentOut,
         sale.Sale,
         module='carrier_formula', type_='model')
+    Pool.register(
+        ir.Cron,
+        sale.SaleShipmentCost,
+        module='carrier_formula', type_='model',
+        depends=['sale_shipment_cost'])
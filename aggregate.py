@@ -0,0 +1,210 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from decimal import Decimal
+
+from sql import Cast, Column, Literal
+from sql.aggregate import Count, Sum
+from sql.conditionals import Coalesce
+
+from trytond.model import fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+from .formula import to_decimal
+from .tools import company_currency, convert
+
+__all__ = ['FIELDS', 'aggregate_lines', 'aggregate_moves',
+    'aggregate_document', 'document_lines_where', 'FormulaTotals']
+# The weight is in kilogram and the volume in liter
+FIELDS = ('line_count', 'quantity', 'amount', 'weight', 'volume')
+_MEASURES = ('weight', 'volume')
+_ZERO = Decimal(0)
+
+
+def _empty():
+    pool = Pool()
+    Template = pool.get('product.template')
+    totals = {
+        'line_count': 0,
+        'quantity': _ZERO,
+        'amount': _ZERO,
+        }
+    for name in _MEASURES:
+        totals[name] = _ZERO if name in Template._fields else None
+    return totals
+
+
+def _convert(amounts, company):
+    "Return the sum of the amounts per currency id in the company currency"
+    amount = _ZERO
+    for currency, currency_amount in amounts.items():
+        if currency and company:
+            currency_amount = convert(
+                currency, currency_amount, company_currency(company.id))
+        amount += currency_amount or _ZERO
+    return amount
+
+
+def aggregate_lines(Line, where, company, currency=None):
+    """Return the totals of the lines matching the where clause
+
+    where is called with the table of Line. The amount is converted from the
+    currency of the lines or currency to the company currency. Weight and
+    volume are None without product measurements."""
+    pool = Pool()
+    Product = pool.get('product.product')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+    line = Line.__table__()
+    product = Product.__table__()
+    template = Template.__table__()
+    unit = Uom.__table__()
+    default_uom = Uom.__table__()
+    cursor = Transaction().connection.cursor()
+
+    quantity = Coalesce(line.quantity, 0)
+    sql_type = Line.unit_price.sql_type().base
+    from_ = (line
+        .join(unit, 'LEFT', condition=line.unit == unit.id)
+        .join(product, 'LEFT', condition=line.product == product.id)
+        .join(template, 'LEFT', condition=product.template == template.id)
+        .join(default_uom, 'LEFT',
+            condition=template.default_uom == default_uom.id))
+    columns = [
+        Count(Literal('*')),
+        Sum(quantity),
+        Sum(Cast(quantity, sql_type) * Coalesce(line.unit_price, 0)),
+        ]
+    # Measures of the quantity converted to the product unit
+    measures = [n for n in _MEASURES if n in Template._fields]
+    for name in measures:
+        measure_uom = Uom.__table__()
+        from_ = from_.join(measure_uom, 'LEFT',
+            condition=Column(template, name + '_uom') == measure_uom.id)
+        columns.append(Sum(quantity * unit.factor / default_uom.factor
+                * Column(template, name) * measure_uom.factor))
+    # The currency of the sale lines is a Function field
+    has_currency = ('currency' in Line._fields
+        and not isinstance(Line._fields['currency'], fields.Function))
+    if has_currency:
+        query = from_.select(line.currency, *columns,
+            where=where(line), group_by=[line.currency])
+    else:
+        query = from_.select(*columns, where=where(line))
+    cursor.execute(*query)
+
+    totals = _empty()
+    amounts = {}
+    for row in cursor:
+        if has_currency:
+            currency_id, row = row[0], row[1:]
+        else:
+            currency_id = currency
+        count, quantity, amount = row[:3]
+        totals['line_count'] += count
+        totals['quantity'] += to_decimal(quantity or 0)
+        amounts[currency_id] = (
+            amounts.get(currency_id, _ZERO) + to_decimal(amount or 0))
+        for name, value in zip(measures, row[3:]):
+            totals[name] += to_decimal(value or 0)
+    totals['amount'] = _convert(amounts, company)
+    return totals
+
+
+def _line_totals(lines, company, currency=None):
+    "Return the totals of lines computed from their values"
+    totals = _empty()
+    amounts = {}
+    for line in lines:
+        quantity = to_decimal(line.quantity or 0)
+        line_currency = getattr(line, 'currency', currency)
+        line_currency = int(line_currency) if line_currency else None
+        totals['line_count'] += 1
+        totals['quantity'] += quantity
+        amounts[line_currency] = amounts.get(line_currency, _ZERO) + (
+            quantity * (getattr(line, 'unit_price', None) or _ZERO))
+        product = getattr(line, 'product', None)
+        unit = getattr(line, 'unit', None)
+        for name in _MEASURES:
+            if totals[name] is None:
+                continue
+            measure = product and getattr(product, name, None)
+            if not measure or not unit:
+                continue
+            totals[name] += to_decimal(
+                float(quantity) * unit.factor / product.default_uom.factor
+                * measure * getattr(product, name + '_uom').factor)
+    totals['amount'] = _convert(amounts, company)
+    return totals
+
+
+def _add(totals, other):
+    for name, value in other.items():
+        if totals[name] is not None:
+            totals[name] += value
+    return totals
+
+
+def aggregate_moves(moves, company):
+    """Return the totals of the stock moves
+
+    The stored moves are aggregated by query."""
+    pool = Pool()
+    Move = pool.get('stock.move')
+    moves = list(moves or [])
+    stored = {m.id for m in moves
+        if m.id is not None and m.id >= 0 and m._values is None}
+    totals = _line_totals(
+        [m for m in moves if m.id not in stored], company,
+        currency=Move.default_currency()
+        if hasattr(Move, 'default_currency') else None)
+    for sub_ids in grouped_slice(stored):
+        _add(totals, aggregate_lines(
+                Move, lambda move: reduce_ids(move.id, sub_ids), company))
+    return totals
+
+
+def document_lines_where(Line, line):
+    "Return the clause of the sale or purchase lines without shipment costs"
+    where = line.type == 'line'
+    if ('shipment_cost' in Line._fields
+            and not isinstance(Line.shipment_cost, fields.Function)):
+        where &= Coalesce(line.shipment_cost, 0) == 0
+    return where
+
+
+def aggregate_document(record, company):
+    "Return the totals of the lines of a sale or a purchase"
+    pool = Pool()
+    currency = record.currency.id if record.currency else None
+    if (record.id is None or record.id < 0
+            or (record._values is not None and 'lines' in record._values)):
+        return _line_totals([line for line in (record.lines or [])
+                if line.type == 'line'
+                and not getattr(line, 'shipment_cost', None)],
+            company, currency=currency)
+    field = record._fields['lines']
+    Line = pool.get(field.model_name)
+
+    def where(line):
+        return ((Column(line, field.field) == record.id)
+            & document_lines_where(Line, line))
+    return aggregate_lines(Line, where, company, currency=currency)
+
+
+class FormulaTotals(object):
+    "Totals of the lines of a record computed on first access"
+    __slots__ = ('_getter', '_values')
+
+    def __init__(self, getter):
+        self._getter = getter
+        self._values = None
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in FIELDS:
+            raise AttributeError('No formula total "%s"' % name)
+        if self._values is None:
+            self._values = self._getter()
+        return self._values[name]
@@ -1,21 +1,52 @@
 # This file is part carrier_formula module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import datetime
+from collections import defaultdict
 from decimal import Decimal
-from simpleeval import simple_eval
+from functools import partial
+from itertools import product
+from sql import Column
 from trytond import backend
-from trytond.model import ModelSQL, ModelView, MatchMixin, sequence_ordered, fields
+from trytond.cache import Cache, LRUDict
+from trytond.config import config
+from trytond.model import (
+    Model, ModelSQL, ModelView, MatchMixin, sequence_ordered, fields)
 from trytond.pyson import Eval, Bool
 from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
-from trytond.tools import decistmt
+from trytond.i18n import gettext
 from trytond.modules.product import price_digits
 
-__all__ = ['Carrier', 'FormulaPriceList']
+from . import instrument
+from .aggregate import (aggregate_document, aggregate_moves,
+    document_lines_where, FormulaTotals, FIELDS as TOTALS_FIELDS)
+from .exceptions import (FormulaPriceError, FormulaSnapshotError,
+    FormulaValidationError)
+from .formula import (compile_formula, record_fields, threshold_index,
+    analyse_formula, evaluator_class, expression_names, tiers_price,
+    to_decimal, FormulaError, FormulaRecord, FUNCTIONS)
+from .snapshot import VERSION as SNAPSHOT_VERSION
+from .tools import (company_currency, currency_digits, quantizer,
+    transaction_cache)
+
+__all__ = ['Carrier', 'FormulaPriceList', 'FormulaPriceListTier']
+# Opt-in duration in seconds of the cache of formula quotes
+_quote_cache_duration = config.getint(
+    'carrier_formula', 'quote_cache_duration', default=0)
+_FINGERPRINT_TYPES = (
+    type(None), bool, int, float, Decimal, str, datetime.date)
+_TOTAL_FIELDS = ('untaxed_amount', 'tax_amount', 'total_amount')
 
 
 class Carrier(metaclass=PoolMeta):
     __name__ = 'carrier'
+    _formula_quote_cache = Cache('carrier.formula_quote',
+        duration=_quote_cache_duration or None, context=False)
+    _formula_buckets = LRUDict(config.getint(
+            'cache', 'carrier.formula_buckets', default=1024))
     formula_currency = fields.Many2One('currency.currency', 'Currency',
         states={
             'invisible': Eval('carrier_cost_method') != 'formula',
@@ -34,42 +65,576 @@ class Carrier(metaclass=PoolMeta):
         selection = ('formula', 'Formula')
         if selection not in cls.carrier_cost_method.selection:
             cls.carrier_cost_method.selection.append(selection)
+        cls.__rpc__.update({
+                'get_sale_prices': RPC(instantiate=0),
+                })
+
+    @classmethod
+    def on_modification(cls, mode, carriers, field_names=None):
+        super().on_modification(mode, carriers, field_names=field_names)
+        if mode in {'write', 'delete'}:
+            cls._formula_quote_cache.clear()
+
+    @classmethod
+    def get_formula_quote_cache_stats(cls):
+        "Return the hit and miss counters of the formula quote cache"
+        return {
+            'hit': cls._formula_quote_cache.hit,
+            'miss': cls._formula_quote_cache.miss,
+            }
 
     @staticmethod
     def default_formula_currency():
-        Company = Pool().get('company.company')
         company_id = Transaction().context.get('company')
         if company_id is not None and company_id >= 0:
-            return Company(company_id).currency.id
+            return company_currency(company_id)
 
     @staticmethod
     def round_price_formula(number, digits):
-        quantize = Decimal(10) ** -Decimal(digits)
-        return Decimal(number).quantize(quantize)
+        return Decimal(number).quantize(quantizer(digits))
 
     def get_context_formula(self, record):
         return {
             'names': {
                 'record': record,
+                'totals': FormulaTotals(
+                    partial(self._get_formula_line_totals, record)),
             },
-            'functions': {
-                'Decimal': Decimal,
-                'round': round,
-                },
+            'functions': dict(FUNCTIONS),
             }
 
+    @classmethod
+    def _get_formula_line_totals(cls, record):
+        "Return the totals of the lines of record shared by the carriers"
+        key = None
+        if isinstance(record, Model):
+            key = cls._get_formula_totals_key(record)
+        if key is None:
+            return cls.get_formula_line_totals(record)
+        context = Transaction().context
+        key += (context.get('company'), context.get('date'))
+        cache = transaction_cache('line_totals')
+        if key not in cache:
+            cache[key] = cls.get_formula_line_totals(record)
+        return cache[key]
+
+    @classmethod
+    def get_formula_line_totals(cls, record):
+        """Return the totals of the lines or moves of the record
+
+        The keys are those of aggregate.FIELDS."""
+        pool = Pool()
+        Company = pool.get('company.company')
+        company = getattr(record, 'company', None)
+        if not company and Transaction().context.get('company') is not None:
+            company = Company(Transaction().context['company'])
+        model = getattr(record, '__name__', None)
+        if isinstance(record, FormulaRecord):
+            # Only the values read by the formulas are available
+            model = None
+        if model in {'sale.sale', 'purchase.purchase'}:
+            return aggregate_document(record, company)
+        elif model == 'stock.shipment.out':
+            return aggregate_moves(
+                record.inventory_moves or record.outgoing_moves, company)
+        elif model == 'stock.shipment.in':
+            return aggregate_moves(record.incoming_moves, company)
+        return aggregate_moves([], company)
+
+    def get_formula_names(self):
+        """Return the names and the functions available to the formulas
+
+        The names and the functions added to get_context_formula must be
+        added here too."""
+        return frozenset({'record', 'totals'}), frozenset(FUNCTIONS)
+
+    def get_formula_evaluator(self, record):
+        if instrument.enabled:
+            Evaluator = instrument.instrumented_evaluator_class()
+        else:
+            Evaluator = evaluator_class()
+        return Evaluator(**self.get_context_formula(record))
+
     def get_formula_pattern(self, record):
         return {}
 
+    @classmethod
+    def load_formula_price_lists(cls, carrier_ids):
+        """Return the currency digits and the price list lines in sequence
+        order of each carrier id
+
+        All the lines are loaded with one query per slice of carriers and kept
+        as instances for the transaction until a record is modified."""
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        FormulaPriceList = pool.get('carrier.formula_price_list')
+        carrier = cls.__table__()
+        currency = Currency.__table__()
+        line = FormulaPriceList.__table__()
+        cursor = Transaction().connection.cursor()
+        cache = transaction_cache('price_lists')
+
+        missing = {i for i in carrier_ids if i not in cache}
+        for sub_ids in grouped_slice(missing):
+            query = (carrier
+                .join(currency, 'LEFT',
+                    condition=carrier.formula_currency == currency.id)
+                .join(line, 'LEFT', condition=line.carrier == carrier.id)
+                .select(carrier.id, currency.digits, line.id,
+                    where=reduce_ids(carrier.id, sub_ids),
+                    order_by=[
+                        carrier.id, line.sequence.asc, line.id.asc]))
+            cursor.execute(*query)
+            loaded = {}
+            for carrier_id, digits, line_id in cursor:
+                _, line_ids = loaded.setdefault(carrier_id, (digits, []))
+                if line_id is not None:
+                    line_ids.append(line_id)
+            # Browse all the lines together to read them with a single query
+            lines = iter(FormulaPriceList.browse(
+                    [i for _, ids in loaded.values() for i in ids]))
+            for carrier_id, (digits, line_ids) in loaded.items():
+                cache[carrier_id] = (
+                    digits, tuple(next(lines) for _ in line_ids))
+        return {i: cache[i] for i in carrier_ids if i in cache}
+
+    @classmethod
+    def get_formula_price_lists(cls, carriers):
+        "Return the price list lines of each carrier in sequence order"
+        # Carriers with pending changes must use their own lines
+        stored = [c.id for c in carriers
+            if c.id is not None and c.id >= 0
+            and (c._values is None or 'formula_price_list' not in c._values)]
+        loaded = cls.load_formula_price_lists(stored)
+        return [list(loaded[c.id][1]) if c.id in loaded
+            else list(c.formula_price_list or []) for c in carriers]
+
+    def get_formula_digits(self):
+        "Return the digits of the formula currency"
+        if (self.id is not None and self.id >= 0
+                and (self._values is None
+                    or 'formula_currency' not in self._values)):
+            loaded = self.load_formula_price_lists([self.id])
+            if self.id in loaded:
+                digits, _ = loaded[self.id]
+                return digits
+        if self.formula_currency:
+            return currency_digits(self.formula_currency.id)
+
+    @classmethod
+    def compute_formula_prices(cls, carriers, records):
+        """Compute price based on formula for each carrier and record
+
+        Return a list with a list of prices per record for each carrier."""
+        price_lists = cls.get_formula_price_lists(carriers)
+        return [[carrier._compute_formula_price(record, lines)
+                for record in records]
+            for carrier, lines in zip(carriers, price_lists)]
+
+    def _get_formula_quote_key(self, record, lines, pattern):
+        "Return the key of the quote cache or None if it can not be cached"
+        if (not _quote_cache_duration
+                or self.id is None or self.id < 0):
+            return
+        revision = self._get_formula_revision(lines)
+        field_names = self._get_formula_fields(lines)
+        if revision is None or field_names is None:
+            return
+        values = []
+        for name in sorted(field_names):
+            try:
+                value = getattr(record, name)
+            except AttributeError:
+                return
+            if not isinstance(value, _FINGERPRINT_TYPES):
+                return
+            values.append((name, value))
+        try:
+            pattern = tuple(sorted(pattern.items()))
+            hash(pattern)
+        except TypeError:
+            return
+        return (self.id, hash(revision), pattern, tuple(values))
+
+    @staticmethod
+    def _get_formula_revision(lines):
+        "Return the revision of the stored lines or None"
+        revision = []
+        for line in lines:
+            if line.id is None or line.id < 0 or line._values is not None:
+                return
+            revision.append((line.id, line.write_date or line.create_date))
+        return tuple(revision)
+
+    @classmethod
+    def _get_formula_band_revision(cls, lines):
+        """Return the revision of the stored lines with their prices and tiers
+        or None
+
+        The values are included because the tiers are modified without the
+        lines and the write date may not change within a transaction."""
+        revision = cls._get_formula_revision(lines)
+        if revision is None:
+            return
+        return revision + tuple(
+            (line.formula, line.price, line.price_type, line.price_formula,
+                line.tier_field,
+                tuple((t.id, t.start, t.rate) for t in line.tiers))
+            for line in lines)
+
+    def _compute_formula_price(self, record, lines):
+        pattern = self.get_formula_pattern(record)
+        key = self._get_formula_quote_key(record, lines, pattern)
+        if key is not None:
+            price = self._formula_quote_cache.get(key)
+            if price is not None:
+                return price
+        price = self._evaluate_formula_price(record, lines, pattern)
+        if key is not None:
+            self._formula_quote_cache.set(key, price)
+        return price
+
+    def _evaluate_formula_price(self, record, lines, pattern):
+        evaluator = self.get_formula_evaluator(record)
+        line = self._find_formula_line(evaluator, lines, pattern)
+        if instrument.enabled:
+            instrument.log_quote(self, line, evaluator)
+        if line:
+            return line.get_unit_price(evaluator)
+        return Decimal(0)
+
+    @classmethod
+    def _get_formula_buckets(cls, lines, names):
+        """Return the positions of the lines grouped by their values for the
+        match criteria names or None if they can not be grouped"""
+        FormulaPriceList = Pool().get('carrier.formula_price_list')
+        if not all(n in FormulaPriceList._fields for n in names):
+            return
+        key = cls._get_formula_revision(lines)
+        if key is not None:
+            key = (key, names)
+            buckets = cls._formula_buckets.get(key)
+            if buckets is not None:
+                return buckets
+
+        buckets = defaultdict(list)
+        for position, line in enumerate(lines):
+            bucket = tuple(line.get_match_value(n) for n in names)
+            try:
+                buckets[bucket].append(position)
+            except TypeError:
+                return
+        buckets = dict(buckets)
+        if key is not None:
+            cls._formula_buckets[key] = buckets
+        return buckets
+
+    def _get_formula_candidates(self, lines, pattern):
+        "Return in order the lines whose criteria can match pattern"
+        pool = Pool()
+        FormulaPriceList = pool.get('carrier.formula_price_list')
+        if not pattern or not lines:
+            return lines
+        names = tuple(sorted(pattern))
+        buckets = self._get_formula_buckets(lines, names)
+        if buckets is None:
+            return lines
+        # Empty criteria of lines match any value
+        values = []
+        for name, value in sorted(pattern.items()):
+            value = FormulaPriceList.get_match_pattern_value(name, value)
+            values.append((None,) if value is None else (None, value))
+        positions = []
+        try:
+            for bucket in product(*values):
+                positions.extend(buckets.get(bucket, []))
+        except TypeError:
+            return lines
+        return [lines[p] for p in sorted(positions)]
+
+    def _find_formula_line(self, evaluator, lines, pattern):
+        "Return the first line matching pattern with a true formula"
+        lines = self._get_formula_candidates(lines, pattern)
+        start = 0
+        # Leading range checks on a same value are found by bisection
+        index = threshold_index(tuple(line.formula or '' for line in lines))
+        if index:
+            value = evaluator.resolve(index.path)
+            if (isinstance(value, (int, float, Decimal))
+                    and value == value):
+                position = index.lookup(value)
+                if position is None:
+                    start = index.size
+                elif lines[position].match(pattern):
+                    return lines[position]
+                else:
+                    # The previous formulas are false
+                    start = position + 1
+        for line in lines[start:]:
+            if line.match(pattern):
+                if evaluator.evaluate(line.get_expression()):
+                    return line
+
     def compute_formula_price(self, record):
         "Compute price based on formula"
-        context = self.get_context_formula(record)
+        [[price]] = self.compute_formula_prices([self], [record])
+        return price
+
+    def get_formula_band(self, record):
+        """Return the key of the band of the inputs of record or None
+
+        The records of a same band have the same price: the inputs are in the
+        same region of the leading threshold formulas when it matches a line
+        with a fixed price, otherwise they have the same values of the record
+        fields read by the formulas."""
+        if self.id is None or self.id < 0:
+            return
+        [lines] = self.get_formula_price_lists([self])
+        revision = self._get_formula_band_revision(lines)
+        field_names = self._get_formula_fields(lines)
+        if revision is None or field_names is None:
+            return
         pattern = self.get_formula_pattern(record)
-        for line in self.formula_price_list:
-            if line.match(pattern):
-                if simple_eval(decistmt(line.formula), **context):
-                    return line.get_unit_price()
-        return Decimal(0)
+        try:
+            key = tuple(sorted(pattern.items()))
+            hash(key)
+        except TypeError:
+            return
+        values = {}
+        totals = None
+        for name in field_names:
+            if (name in _TOTAL_FIELDS
+                    and getattr(record, '__name__', None) in {
+                        'sale.sale', 'purchase.purchase'}):
+                # The totals are cached by the transaction
+                if totals is None:
+                    untaxed_amount, tax_amount = self.get_formula_totals(
+                        record)
+                    totals = dict(zip(_TOTAL_FIELDS, (untaxed_amount,
+                                tax_amount, untaxed_amount + tax_amount)))
+                value = totals[name]
+            else:
+                try:
+                    value = getattr(record, name)
+                except AttributeError:
+                    return
+            if not isinstance(value, _FINGERPRINT_TYPES):
+                return
+            values[name] = value
+        inputs = tuple(sorted(values.items()))
+
+        lines = self._get_formula_candidates(lines, pattern)
+        index = threshold_index(tuple(line.formula or '' for line in lines))
+        if index and index.path[0] == 'record' and len(index.path) == 2:
+            value = values.get(index.path[1])
+            if (isinstance(value, (int, float, Decimal))
+                    and value == value):
+                position = index.lookup(value)
+                if (position is not None
+                        and lines[position].match(pattern)
+                        and lines[position].price_type == 'fixed'):
+                    inputs = ('region', index.region(value))
+        return (self.id, revision, key, inputs)
+
+    def export_formula_snapshot(self):
+        """Return the snapshot of the price list as a JSON serializable dict
+
+        The snapshot is quoted by snapshot.SnapshotEvaluator without pool
+        nor transaction. Lines with match criteria are not supported."""
+        pool = Pool()
+        FormulaPriceList = pool.get('carrier.formula_price_list')
+        [lines] = self.get_formula_price_lists([self])
+        criteria = sorted(FormulaPriceList.get_match_criteria())
+        for line in lines:
+            for name in criteria:
+                if line.get_match_value(name) is not None:
+                    raise FormulaSnapshotError(gettext(
+                            'carrier_formula.msg_formula_snapshot_criteria',
+                            carrier=self.rec_name,
+                            line=line.rec_name,
+                            criteria=FormulaPriceList._fields[name].string))
+        _, functions = self.get_formula_names()
+        names = set()
+        for line in lines:
+            names |= expression_names(line.get_expression())
+            if line.price_type == 'formula':
+                names |= expression_names(
+                    compile_formula(line.price_formula))
+            elif line.price_type == 'tiers':
+                names.add(line.get_tier_path()[0])
+        return {
+            'version': SNAPSHOT_VERSION,
+            'carrier': self.id,
+            'date': datetime.datetime.now().isoformat(),
+            'digits': self.get_formula_digits(),
+            'names': sorted(names),
+            'functions': sorted(functions),
+            'lines': [{
+                    'id': line.id,
+                    'formula': line.formula,
+                    'price_type': line.price_type,
+                    'price': str(line.price),
+                    'price_formula': line.price_formula,
+                    'tier_field': line.tier_field,
+                    'tiers': [[str(t.start), str(t.rate)]
+                        for t in line.tiers],
+                    } for line in lines],
+            }
+
+    def get_formula_record_fields(self):
+        """Return the record fields read to quote or None if unknown
+
+        Extensions reading other record fields in get_context_formula or
+        get_formula_pattern must add them."""
+        [lines] = self.get_formula_price_lists([self])
+        return self._get_formula_fields(lines)
+
+    @staticmethod
+    def _get_formula_fields(lines):
+        field_names = set()
+        for line in lines:
+            names = line.get_formula_fields()
+            if names is None:
+                return
+            field_names.update(names)
+        return frozenset(field_names)
+
+    @classmethod
+    def get_formula_record(cls, field_names=None):
+        """Return the record and its model name to quote from the context
+
+        If field_names is set, the values of those fields may be returned
+        in a read only record that fails on any other field."""
+        pool = Pool()
+        context = Transaction().context
+        record = context.get('record')
+        model = context.get('record_model')
+        if not record:
+            return None, model
+        if isinstance(record, str):
+            model, id = record.split(',')
+            record = int(id)
+        elif isinstance(record, dict) and not model:
+            return None, model
+        elif not isinstance(record, dict):
+            return record, record.__name__
+
+        Model = pool.get(model)
+        with instrument.timer('record'):
+            if field_names is not None and all(
+                    n in Model._fields
+                    and Model._fields[n]._type not in {
+                        'many2one', 'one2many', 'many2many', 'one2one',
+                        'reference'}
+                    for n in field_names):
+                if isinstance(record, dict):
+                    values = {n: record[n] for n in field_names if n in record}
+                elif field_names:
+                    values, = Model.read([record], list(field_names))
+                    del values['id']
+                else:
+                    values = {}
+                return FormulaRecord(model, values), model
+            # is an object that not saved (has not id)
+            if isinstance(record, dict):
+                record = Model(**record)
+            else:
+                record = Model(record)
+            return record, model
+
+    @staticmethod
+    def _get_formula_totals_key(record):
+        "Return the key of the totals of record or None if not cached"
+        if record.id is not None and record.id >= 0 and record._values is None:
+            return (record.__name__, record.id)
+
+    @classmethod
+    def _get_formula_untaxed_amounts(cls, records):
+        """Return the untaxed amount without shipment costs of each record
+
+        The lines of the stored records are read with one query per model."""
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+        amounts = [Decimal(0)] * len(records)
+        models = defaultdict(list)
+        for i, record in enumerate(records):
+            if (record.id is None or record.id < 0
+                    or (record._values is not None
+                        and 'lines' in record._values)):
+                amounts[i] = sum((line.amount for line in record.lines
+                        if line.type == 'line' and line.amount
+                        and not getattr(line, 'shipment_cost', None)),
+                    Decimal(0))
+            else:
+                models[record.__name__].append(i)
+        for positions in models.values():
+            field = records[positions[0]]._fields['lines']
+            Line = pool.get(field.model_name)
+            line = Line.__table__()
+            parent = Column(line, field.field)
+            by_id = defaultdict(list)
+            for i in positions:
+                by_id[records[i].id].append(i)
+            for sub_ids in grouped_slice(list(by_id)):
+                cursor.execute(*line.select(
+                        parent, line.quantity, line.unit_price,
+                        where=reduce_ids(parent, sub_ids)
+                        & document_lines_where(Line, line)))
+                for record_id, quantity, unit_price in cursor:
+                    for i in by_id[record_id]:
+                        # Rounded per line as the amount field
+                        amount = (Decimal(str(quantity or 0))
+                            * (unit_price or Decimal(0)))
+                        currency = records[i].currency
+                        if currency:
+                            amount = currency.round(amount)
+                        amounts[i] += amount
+        return amounts
+
+    @classmethod
+    def get_formula_totals_list(cls, records):
+        """Return the untaxed amount without shipment costs and the tax amount
+        of each sale or purchase"""
+        # The totals are kept until a record is modified by the transaction
+        cache = transaction_cache('totals')
+        keys = [cls._get_formula_totals_key(r) for r in records]
+        totals = [cache.get(k) if k is not None else None for k in keys]
+        missing = [i for i, t in enumerate(totals) if t is None]
+        untaxed_amounts = cls._get_formula_untaxed_amounts(
+            [records[i] for i in missing])
+        for i, untaxed_amount in zip(missing, untaxed_amounts):
+            record, key = records[i], keys[i]
+            if (key is not None
+                    and record.state in getattr(record, '_states_cached', [])
+                    and record.tax_amount_cache is not None):
+                tax_amount = record.tax_amount_cache
+            else:
+                with instrument.timer('get_tax_amount'):
+                    tax_amount = record.get_tax_amount()
+            totals[i] = (untaxed_amount, tax_amount)
+            if key is not None:
+                cache[key] = totals[i]
+        return totals
+
+    @classmethod
+    def get_formula_totals(cls, record):
+        """Return the untaxed amount without shipment costs and the tax amount
+        of a sale or a purchase"""
+        [totals] = cls.get_formula_totals_list([record])
+        return totals
+
+    @classmethod
+    def set_formula_totals_list(cls, records):
+        for record, (untaxed_amount, tax_amount) in zip(
+                records, cls.get_formula_totals_list(records)):
+            record.untaxed_amount = untaxed_amount
+            record.tax_amount = tax_amount
+            record.total_amount = untaxed_amount + tax_amount
+
+    def set_formula_totals(self, record):
+        record.untaxed_amount, record.tax_amount = (
+            self.get_formula_totals(record))
+        record.total_amount = record.untaxed_amount + record.tax_amount
 
     def get_sale_price(self):
         # Designed to get shipment price with a current sale (default)
@@ -93,84 +658,125 @@ class Carrier(metaclass=PoolMeta):
             price = Decimal(0)
             currency_id = self.formula_currency.id
             carrier = Transaction().context.get('carrier', None)
-            record = Transaction().context.get('record', None)
-            model = Transaction().context.get('record_model', None)
-
+            if carrier:
+                # Only the formulas read the record
+                record, model = self.get_formula_record(
+                    self.get_formula_record_fields())
+            else:
+                record, model = self.get_formula_record()
             if not record:
                 return price, currency_id
 
-            # is an object that not saved (has not id)
-            if isinstance(record, dict):
-                if not model:
-                    return price, currency_id
-                record = Pool().get(model)(**record)
-            elif isinstance(record, str):
-                model, id = record.split(',')
-                record = Pool().get(model)(id)
-
             if carrier:
                 price = self.compute_formula_price(record)
             else:
                 if model == 'sale.sale':
-                    if record.carrier:
-                        record.untaxed_amount = Decimal(0)
-                        for line in record.lines:
-                            if (hasattr(line, 'shipment_cost')
-                                    and line.shipment_cost):
-                                continue
-                            if line.amount and line.type == 'line':
-                                record.untaxed_amount += line.amount
-                        record.tax_amount = record.get_tax_amount()
-                        record.total_amount = (
-                            record.untaxed_amount + record.tax_amount)
-
+                    # Prices may be already quoted by a batch
+                    prices = Transaction().context.get('formula_prices', {})
+                    key = (self.id, str(record))
+                    if record.carrier and key in prices:
+                        price = prices[key]
+                    elif record.carrier:
+                        self.set_formula_totals(record)
                         price = self.compute_formula_price(record)
                     else:
                         price = self.carrier_product.list_price
 
-        price = self.round_price_formula(price, self.formula_currency.digits)
+        price = self.round_price_formula(price, self.get_formula_digits())
         return price, currency_id
 
+    @classmethod
+    def get_sale_prices(cls, carriers, record, record_model='sale.sale'):
+        """Return the sale price and currency id of each carrier for record
+
+        record is the dictionary of values of a hypothetical sale as for the
+        cart quotes of get_sale_price. The record is read once and the price
+        lists of all formula carriers are loaded together."""
+        transaction = Transaction()
+        context = {
+            'record': record,
+            'record_model': record_model,
+            }
+        prices = {}
+        formula_carriers = [c for c in carriers
+            if c.carrier_cost_method == 'formula']
+        if formula_carriers:
+            field_names = set()
+            for carrier in formula_carriers:
+                names = carrier.get_formula_record_fields()
+                if names is None:
+                    field_names = None
+                    break
+                field_names.update(names)
+            with transaction.set_context(
+                    carrier=formula_carriers[0].id, **context):
+                formula_record, _ = cls.get_formula_record(field_names)
+            if formula_record:
+                quotes = cls.compute_formula_prices(
+                    formula_carriers, [formula_record])
+            else:
+                quotes = [[Decimal(0)]] * len(formula_carriers)
+            for carrier, [price] in zip(formula_carriers, quotes):
+                prices[carrier] = (
+                    carrier.round_price_formula(
+                        price, carrier.get_formula_digits()),
+                    carrier.formula_currency.id)
+        result = []
+        for carrier in carriers:
+            if carrier not in prices:
+                with transaction.set_context(carrier=carrier.id, **context):
+                    prices[carrier] = carrier.get_sale_price()
+            result.append(prices[carrier])
+        return result
+
     def get_purchase_price(self):
         price, currency_id = super(Carrier, self).get_purchase_price()
 
         if self.carrier_cost_method == 'formula':
             price = Decimal(0)
             currency_id = self.formula_currency.id
-            record = Transaction().context.get('record', None)
-            model = Transaction().context.get('record_model', None)
-
+            record, model = self.get_formula_record()
             if not record:
                 return price, currency_id
 
-            # is an object that not saved (has not id)
-            if isinstance(record, dict):
-                if not model:
-                    return price, currency_id
-                record = Pool().get(model)(**record)
-            else:
-                model, id = record.split(',')
-                record = Pool().get(model)(id)
-
             if model == 'purchase.purchase':
                 if record.carrier:
-                    record.untaxed_amount = Decimal(0)
-                    for line in record['lines']:
-                        if (not line.shipment_cost
-                                and line.amount
-                                and line.type == 'line'):
-                            record.untaxed_amount += line.amount
-                    record.tax_amount = record.get_tax_amount()
-                    record.total_amount = (
-                        record.untaxed_amount + record.tax_amount)
-
+                    self.set_formula_totals(record)
                     price = self.compute_formula_price(record)
                 else:
                     price = self.carrier_product.list_price
 
-        price = self.round_price_formula(price, self.formula_currency.digits)
+        price = self.round_price_formula(price, self.get_formula_digits())
         return price, currency_id
 
+    @classmethod
+    def get_purchase_prices(cls, purchases):
+        """Return the price and currency id of the formula carrier of each
+        purchase or None if it has no formula carrier
+
+        The totals of all the purchases are computed together and the
+        purchases of a carrier are quoted at once."""
+        purchases = list(purchases)
+        positions = defaultdict(list)
+        for i, purchase in enumerate(purchases):
+            if (purchase.carrier
+                    and purchase.carrier.carrier_cost_method == 'formula'):
+                positions[purchase.carrier].append(i)
+        quoted = [i for c_positions in positions.values()
+            for i in c_positions]
+        cls.set_formula_totals_list([purchases[i] for i in quoted])
+        result = [None] * len(purchases)
+        # Load the price lists of all the carriers at once
+        cls.load_formula_price_lists([c.id for c in positions])
+        for carrier, c_positions in positions.items():
+            [prices] = cls.compute_formula_prices(
+                [carrier], [purchases[i] for i in c_positions])
+            digits = carrier.get_formula_digits()
+            for i, price in zip(c_positions, prices):
+                result[i] = (carrier.round_price_formula(price, digits),
+                    carrier.formula_currency.id)
+        return result
+
 
 class FormulaPriceList(sequence_ordered(), ModelSQL, ModelView, MatchMixin):
     'Carrier Formula Price List'
@@ -180,7 +786,44 @@ class FormulaPriceList(sequence_ordered(), ModelSQL, ModelView, MatchMixin):
     formula = fields.Char('Formula', required=True,
         help=('Python expression that will be evaluated. Eg:\n'
             'getattr(record, "total_amount") > 0'))
+    price_type = fields.Selection([
+            ('fixed', "Fixed"),
+            ('formula', "Formula"),
+            ('tiers', "Tiers"),
+            ], "Price Type", required=True,
+        help="Fixed: the price.\n"
+        "Formula: the result of the price formula.\n"
+        "Tiers: the price plus the rate of each tier per unit of the tier "
+        "field above its start.")
     price = fields.Numeric('Price', required=True, digits=price_digits)
+    price_formula = fields.Char("Price Formula",
+        states={
+            'invisible': Eval('price_type') != 'formula',
+            'required': Eval('price_type') == 'formula',
+            },
+        help="Python expression that will be evaluated. Eg:\n"
+        "Decimal('5') + record.weight * Decimal('0.5')")
+    tier_field = fields.Char("Tier Field",
+        states={
+            'invisible': Eval('price_type') != 'tiers',
+            'required': Eval('price_type') == 'tiers',
+            },
+        help="The record field on which the tiers apply. Eg: weight\n"
+        "Or the path of a name of the formulas. Eg: totals.weight")
+    tiers = fields.One2Many(
+        'carrier.formula_price_list.tier', 'line', "Tiers",
+        states={
+            'invisible': Eval('price_type') != 'tiers',
+            })
+    formula_fields = fields.Char('Formula Fields', readonly=True,
+        help="The record fields read by the formula.\n"
+        "Empty if they can not be determined.")
+    formula_complexity = fields.Selection([
+            (None, ''),
+            ('threshold', "Threshold"),
+            ('simple', "Simple"),
+            ('complex', "Complex"),
+            ], 'Formula Complexity', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -205,19 +848,217 @@ class FormulaPriceList(sequence_ordered(), ModelSQL, ModelView, MatchMixin):
         return Decimal(0)
 
     @classmethod
-    def validate(cls, lines):
-        super(FormulaPriceList, cls).validate(lines)
-        for line in lines:
-            line.check_formula()
+    def default_price_type(cls):
+        return 'fixed'
+
+    @classmethod
+    def preprocess_values(cls, mode, values):
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        values = super().preprocess_values(mode, values)
+        if values.get('formula'):
+            if values.get('carrier') is not None:
+                names = Carrier(values['carrier']).get_formula_names()
+            else:
+                names = Carrier().get_formula_names()
+            try:
+                analysis = analyse_formula(values['formula'], *names)
+            except FormulaError:
+                # check_formula reports the error
+                values['formula_fields'] = None
+                values['formula_complexity'] = None
+            else:
+                if analysis.fields is not None:
+                    values['formula_fields'] = ','.join(
+                        sorted(analysis.fields))
+                else:
+                    values['formula_fields'] = None
+                values['formula_complexity'] = analysis.complexity
+        return values
+
+    @classmethod
+    def validate_fields(cls, lines, field_names):
+        super().validate_fields(lines, field_names)
+        # The lines saved before the validation was added stay writable
+        if field_names is None or field_names & {
+                'formula', 'price_type', 'price_formula', 'tier_field'}:
+            for line in lines:
+                line.check_formula()
+
+    @classmethod
+    def on_modification(cls, mode, lines, field_names=None):
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        super().on_modification(mode, lines, field_names=field_names)
+        if mode in {'write', 'delete'}:
+            # The write date may not change within a transaction
+            Carrier._formula_buckets.clear()
+        Carrier._formula_quote_cache.clear()
+
+    def get_expression(self):
+        "Return the compiled expression of the formula"
+        return compile_formula(self.formula)
+
+    def get_formula_fields(self):
+        """Return the record fields read by the formulas or None if unknown
+        or if they read other names"""
+        if (self.id is not None and self.id >= 0 and self._values is None
+                and self.formula_complexity is not None):
+            # An empty string is stored when no record field is read
+            if self.formula_fields is None:
+                return
+            field_names = frozenset(
+                filter(None, self.formula_fields.split(',')))
+            expressions = []
+        else:
+            field_names = frozenset()
+            expressions = [self.get_expression()]
+        if self.price_type == 'formula':
+            expressions.append(compile_formula(self.price_formula or ''))
+        elif self.price_type == 'tiers':
+            path = self.get_tier_path()
+            if path[0] != 'record' or len(path) != 2:
+                return
+            field_names |= {path[1]}
+        for expression in expressions:
+            names = record_fields((expression,))
+            if names is None or not expression_names(expression) <= {
+                    'record'}:
+                return
+            field_names |= names
+        return field_names
+
+    def get_tier_path(self):
+        "Return the operand path of the tier field"
+        if '.' in (self.tier_field or ''):
+            return tuple(self.tier_field.split('.'))
+        return ('record', self.tier_field)
 
     def check_formula(self):
         '''
         Check formula
         '''
+        names = self.carrier.get_formula_names()
+        formulas = [self.formula]
+        if self.price_type == 'formula':
+            formulas.append(self.price_formula)
+        try:
+            for formula in formulas:
+                analyse_formula(formula, *names)
+        except FormulaError as exception:
+            message = {
+                'name': 'msg_formula_unknown_name',
+                'function': 'msg_formula_unknown_function',
+                'complexity': 'msg_formula_too_complex',
+                'expensive': 'msg_formula_expensive',
+                }.get(exception.kind, 'invalid_fromula')
+            raise FormulaValidationError(gettext(
+                    'carrier_formula.%s' % message,
+                    formula=formula,
+                    line=self.rec_name,
+                    detail=exception.detail)) from exception
+        if self.price_type == 'tiers':
+            self.check_tier_field(names)
         return True
 
+    def check_tier_field(self, names):
+        "Check the tier field is a record field or a path of the names"
+        path = self.get_tier_path() if self.tier_field else ()
+        try:
+            if len(path) != 2:
+                raise FormulaError('syntax', self.tier_field)
+            analyse_formula('.'.join(path), *names)
+            if path[0] == 'totals' and path[1] not in TOTALS_FIELDS:
+                raise FormulaError('name', path[1])
+        except FormulaError as exception:
+            raise FormulaValidationError(gettext(
+                    'carrier_formula.msg_formula_invalid_tier_field',
+                    field=self.tier_field,
+                    line=self.rec_name)) from exception
+
     def match(self, pattern):
         return super(FormulaPriceList, self).match(pattern)
 
-    def get_unit_price(self):
+    @classmethod
+    def get_match_criteria(cls):
+        """Return the names of the fields of the match criteria
+
+        The fields added by other modules are taken as criteria."""
+        pool = Pool()
+        Field = pool.get('ir.model.field')
+        names = set()
+        for field in Field.search([
+                    ('model', '=', cls.__name__),
+                    ('module', '!=', 'carrier_formula'),
+                    ]):
+            field = cls._fields.get(field.name)
+            if (field is not None
+                    and not isinstance(field, fields.Function)
+                    and field._type not in {'one2many', 'many2many'}):
+                names.add(field.name)
+        return names
+
+    def get_match_value(self, name):
+        "Return the value of the criteria name as compared by match"
+        value = getattr(self, name)
+        if value == '':
+            value = None
+        if value is not None:
+            field = self._fields[name]
+            if field._type == 'many2one':
+                value = value.id
+            elif field._type == 'boolean':
+                value = bool(value)
+        return value
+
+    @classmethod
+    def get_match_pattern_value(cls, name, value):
+        "Return the pattern value of the criteria name as compared by match"
+        if cls._fields[name]._type == 'boolean':
+            value = bool(value)
+        return value
+
+    def get_unit_price(self, evaluator=None):
+        """Return the price for the record of the evaluator
+
+        The price of the line is returned without evaluator."""
+        if evaluator is None:
+            return self.price
+        if self.price_type == 'formula':
+            price = evaluator.evaluate(compile_formula(self.price_formula))
+            try:
+                return to_decimal(price)
+            except (TypeError, ArithmeticError) as exception:
+                raise FormulaPriceError(gettext(
+                        'carrier_formula.msg_formula_price_not_number',
+                        formula=self.price_formula,
+                        line=self.rec_name,
+                        value=price)) from exception
+        elif self.price_type == 'tiers':
+            value = evaluator.resolve(self.get_tier_path())
+            return tiers_price(self.price, [(t.start, t.rate)
+                    for t in self.tiers], value)
         return self.price
+
+
+class FormulaPriceListTier(ModelSQL, ModelView):
+    "Carrier Formula Price List Tier"
+    __name__ = 'carrier.formula_price_list.tier'
+    line = fields.Many2One('carrier.formula_price_list', "Line",
+        required=True, ondelete='CASCADE')
+    start = fields.Numeric("Start", required=True,
+        help="The value of the tier field above which the rate applies.")
+    rate = fields.Numeric("Rate", required=True, digits=price_digits,
+        help="The price per unit of the tier field above the start.")
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('start', 'ASC'))
+
+    @classmethod
+    def on_modification(cls, mode, tiers, field_names=None):
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        super().on_modification(mode, tiers, field_names=field_names)
+        Carrier._formula_quote_cache.clear()
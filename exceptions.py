@@ -0,0 +1,17 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.exceptions import UserError
+from trytond.model.exceptions import ValidationError
+
+
+class FormulaValidationError(ValidationError):
+    pass
+
+
+class FormulaPriceError(UserError):
+    pass
+
+
+class FormulaSnapshotError(UserError):
+    pass
@@ -0,0 +1,490 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import ast
+from bisect import bisect_left
+from decimal import Decimal
+from functools import lru_cache
+
+from trytond.config import config
+from trytond.tools import decistmt
+
+__all__ = ['compile_formula', 'parse_expression', 'evaluator_class',
+    'threshold_index', 'ThresholdIndex', 'record_fields', 'FormulaRecord',
+    'analyse_formula', 'FormulaAnalysis', 'FormulaError', 'FUNCTIONS',
+    'to_decimal', 'tiers_price', 'expression_names']
+_CACHE_SIZE = config.getint(
+    'cache', 'carrier.formula_price_list.parse', default=1024)
+MAX_NODES = config.getint('carrier_formula', 'max_nodes', default=200)
+MAX_DEPTH = config.getint('carrier_formula', 'max_depth', default=20)
+MAX_POWER = 100
+# Functions available to the formulas
+FUNCTIONS = {
+    'Decimal': Decimal,
+    'round': round,
+    }
+# Constructs not supported by the evaluator
+# The size of the literal containers is limited by MAX_NODES
+_UNSUPPORTED = (
+    ast.Lambda, ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp,
+    ast.NamedExpr, ast.Await, ast.Yield, ast.YieldFrom, ast.Starred,
+    ast.Dict)
+
+
+class _GetattrTransformer(ast.NodeTransformer):
+    "Rewrite getattr(obj, 'name') as obj.name"
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if (isinstance(node.func, ast.Name)
+                and node.func.id == 'getattr'
+                and len(node.args) == 2
+                and not node.keywords
+                and isinstance(node.args[1], ast.Constant)
+                and isinstance(node.args[1].value, str)
+                and node.args[1].value.isidentifier()):
+            return ast.copy_location(
+                ast.Attribute(
+                    value=node.args[0], attr=node.args[1].value,
+                    ctx=ast.Load()),
+                node)
+        return node
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def compile_formula(formula):
+    "Return the expression of formula with numbers rewritten as Decimal"
+    # getattr is not allowed by simpleeval so the documented
+    # getattr(record, "field") form is rewritten as attribute access
+    if 'getattr' in formula:
+        try:
+            tree = ast.parse(formula.strip(), mode='eval')
+        except SyntaxError:
+            pass
+        else:
+            formula = ast.unparse(_GetattrTransformer().visit(tree))
+    return decistmt(formula)
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def parse_expression(expression):
+    "Return the parsed node tree of a compiled expression"
+    # The tree only depends on the text of the expression so it can be
+    # shared by all the transactions of the process
+    return evaluator_class().parse(expression)
+
+
+@lru_cache(maxsize=None)
+def evaluator_class():
+    """Return the FormulaEvaluator class
+
+    simpleeval is only imported by the first quote so the workers which
+    never quote do not load it."""
+    from simpleeval import SimpleEval
+
+    class FormulaEvaluator(SimpleEval):
+        "Evaluator reusable for many expressions with the same names"
+
+        def __init__(self, names=None, functions=None):
+            super().__init__(functions=functions, names=names)
+            # Literal containers like record.code in ("ES", "PT")
+            self.nodes.update({
+                    ast.Tuple: self._eval_tuple,
+                    ast.List: self._eval_list,
+                    ast.Set: self._eval_set,
+                    })
+
+        def _eval_tuple(self, node):
+            return tuple(self._eval(e) for e in node.elts)
+
+        def _eval_list(self, node):
+            return [self._eval(e) for e in node.elts]
+
+        def _eval_set(self, node):
+            return {self._eval(e) for e in node.elts}
+
+        def evaluate(self, expression):
+            return self.eval(
+                expression, previously_parsed=parse_expression(expression))
+
+        def resolve(self, path):
+            "Return the value of the operand path or None if not available"
+            try:
+                value = self.names[path[0]]
+                for name in path[1:]:
+                    if name.startswith('_'):
+                        return None
+                    value = getattr(value, name)
+            except Exception:
+                return None
+            return value
+    FormulaEvaluator.__qualname__ = 'FormulaEvaluator'
+    return FormulaEvaluator
+
+
+def __getattr__(name):
+    if name == 'FormulaEvaluator':
+        return evaluator_class()
+    raise AttributeError(
+        "module '%s' has no attribute '%s'" % (__name__, name))
+
+
+def to_decimal(value):
+    """Return value as Decimal
+
+    TypeError is raised for None and booleans."""
+    if isinstance(value, Decimal):
+        return value
+    elif isinstance(value, float):
+        return Decimal(str(value))
+    elif isinstance(value, bool):
+        raise TypeError('Boolean "%s" is not a number' % value)
+    return Decimal(value)
+
+
+def tiers_price(price, tiers, value):
+    """Return price plus the rate of each tier per unit of value above its
+    start up to the start of the next tier
+
+    tiers is a list of (start, rate)."""
+    if value is None:
+        return price
+    value = to_decimal(value)
+    tiers = sorted(tiers)
+    for i, (start, rate) in enumerate(tiers):
+        if value <= start:
+            break
+        if i + 1 < len(tiers):
+            end = min(value, tiers[i + 1][0])
+        else:
+            end = value
+        price += rate * (end - start)
+    return price
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def record_fields(expressions, name='record'):
+    """Return the attributes of name read by the compiled expressions
+
+    None is returned if name is used otherwise than to read attributes."""
+    fields = set()
+    for expression in expressions:
+        try:
+            tree = parse_expression(expression)
+        except SyntaxError:
+            return
+        attributes = uses = 0
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Attribute)
+                    and isinstance(node.value, ast.Name)
+                    and node.value.id == name):
+                fields.add(node.attr)
+                attributes += 1
+            elif isinstance(node, ast.Name) and node.id == name:
+                uses += 1
+        if uses != attributes:
+            return
+    return frozenset(fields)
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def expression_names(expression):
+    "Return the names other than called functions used by the expression"
+    try:
+        tree = parse_expression(expression)
+    except SyntaxError:
+        return frozenset()
+    functions = {id(n.func) for n in ast.walk(tree)
+        if isinstance(n, ast.Call)}
+    return frozenset(n.id for n in ast.walk(tree)
+        if isinstance(n, ast.Name) and id(n) not in functions)
+
+
+class FormulaRecord(object):
+    "Read only record exposing only the values read by the formulas"
+    __slots__ = ('__name__', '_formula_values')
+
+    def __init__(self, name, values):
+        object.__setattr__(self, '__name__', name)
+        object.__setattr__(self, '_formula_values', values)
+
+    def __getattr__(self, name):
+        try:
+            return self._formula_values[name]
+        except KeyError:
+            raise AttributeError(
+                '"%s" has no formula value "%s"' % (self.__name__, name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('"%s" is read only' % self.__name__)
+
+
+_COMPARE = {
+    ast.Gt: ('lower', False),
+    ast.GtE: ('lower', True),
+    ast.Lt: ('upper', False),
+    ast.LtE: ('upper', True),
+    }
+_MIRROR = {ast.Gt: ast.Lt, ast.GtE: ast.LtE, ast.Lt: ast.Gt, ast.LtE: ast.GtE}
+
+
+def _operand(node):
+    "Return the path of names of a record value operand"
+    if isinstance(node, ast.Name):
+        return (node.id,)
+    elif isinstance(node, ast.Attribute):
+        path = _operand(node.value)
+        if path is not None:
+            return path + (node.attr,)
+    elif (isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == 'getattr'
+            and len(node.args) == 2
+            and not node.keywords
+            and isinstance(node.args[1], ast.Constant)
+            and isinstance(node.args[1].value, str)
+            and node.args[1].value.isidentifier()):
+        path = _operand(node.args[0])
+        if path is not None:
+            return path + (node.args[1].value,)
+
+
+def _number(node):
+    "Return the Decimal value of a constant node"
+    if isinstance(node, ast.Constant):
+        if (isinstance(node.value, (int, float))
+                and not isinstance(node.value, bool)):
+            return Decimal(str(node.value))
+    elif isinstance(node, ast.UnaryOp) and isinstance(
+            node.op, (ast.UAdd, ast.USub)):
+        value = _number(node.operand)
+        if value is not None:
+            return -value if isinstance(node.op, ast.USub) else value
+    elif (isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == 'Decimal'
+            and len(node.args) == 1
+            and not node.keywords
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)):
+        try:
+            return Decimal(node.args[0].value)
+        except ArithmeticError:
+            return None
+
+
+class _Interval(object):
+    "Interval of values of an operand"
+    __slots__ = ('path', 'lower', 'lower_closed', 'upper', 'upper_closed')
+
+    def __init__(self, path):
+        self.path = path
+        self.lower = self.upper = None
+        self.lower_closed = self.upper_closed = False
+
+    def restrict(self, bound, value, closed):
+        if bound == 'lower':
+            if (self.lower is None or value > self.lower
+                    or (value == self.lower and not closed)):
+                self.lower, self.lower_closed = value, closed
+        else:
+            if (self.upper is None or value < self.upper
+                    or (value == self.upper and not closed)):
+                self.upper, self.upper_closed = value, closed
+
+    def __contains__(self, value):
+        if self.lower is not None:
+            if value < self.lower or (
+                    value == self.lower and not self.lower_closed):
+                return False
+        if self.upper is not None:
+            if value > self.upper or (
+                    value == self.upper and not self.upper_closed):
+                return False
+        return True
+
+    def bounds(self):
+        return [v for v in (self.lower, self.upper) if v is not None]
+
+
+def _restrict(interval, node):
+    "Restrict interval with the comparisons of node"
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        for value in node.values:
+            interval = _restrict(interval, value)
+            if interval is None:
+                return
+        return interval
+    if not isinstance(node, ast.Compare):
+        return
+    left = node.left
+    for op, right in zip(node.ops, node.comparators):
+        if type(op) not in _COMPARE:
+            return
+        path, value = _operand(left), _number(right)
+        if path is None or value is None:
+            path, value = _operand(right), _number(left)
+            if path is None or value is None:
+                return
+            op = _MIRROR[type(op)]()
+        if interval is None:
+            interval = _Interval(path)
+        elif interval.path != path:
+            return
+        bound, closed = _COMPARE[type(op)]
+        interval.restrict(bound, value, closed)
+        left = right
+    return interval
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def threshold_interval(formula):
+    "Return the interval of a comparison only formula or None"
+    try:
+        tree = ast.parse(formula.strip(), mode='eval')
+    except SyntaxError:
+        return
+    return _restrict(None, tree.body)
+
+
+class ThresholdIndex(object):
+    """Sorted index of the first matching formula per value of an operand
+
+    The values are split into regions by the bounds of the intervals, each
+    region having a constant first matching position."""
+    __slots__ = ('path', 'size', '_bounds', '_positions')
+
+    def __init__(self, path, intervals):
+        self.path = path
+        self.size = len(intervals)
+        self._bounds = sorted({b for i in intervals for b in i.bounds()})
+        samples = []
+        for i, bound in enumerate(self._bounds):
+            if i:
+                samples.append((self._bounds[i - 1] + bound) / 2)
+            else:
+                samples.append(bound - 1)
+            samples.append(bound)
+        if self._bounds:
+            samples.append(self._bounds[-1] + 1)
+        else:
+            samples.append(Decimal(0))
+        self._positions = []
+        for sample in samples:
+            for position, interval in enumerate(intervals):
+                if sample in interval:
+                    break
+            else:
+                position = None
+            self._positions.append(position)
+
+    def region(self, value):
+        "Return the number of the region containing value"
+        i = bisect_left(self._bounds, value)
+        if i < len(self._bounds) and self._bounds[i] == value:
+            return 2 * i + 1
+        return 2 * i
+
+    def lookup(self, value):
+        "Return the position of the first interval containing value"
+        return self._positions[self.region(value)]
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def threshold_index(formulas):
+    """Return the index of the leading threshold formulas on a same operand
+
+    None is returned if the first formula is not a threshold."""
+    intervals = []
+    for formula in formulas:
+        interval = threshold_interval(formula)
+        if interval is None or (
+                intervals and interval.path != intervals[0].path):
+            break
+        intervals.append(interval)
+    if intervals:
+        return ThresholdIndex(intervals[0].path, intervals)
+
+
+class FormulaError(ValueError):
+    "Invalid formula with the kind of error and its detail"
+
+    def __init__(self, kind, detail=''):
+        super().__init__(kind, detail)
+        self.kind = kind
+        self.detail = detail
+
+
+class FormulaAnalysis(object):
+    "Result of the static analysis of a formula"
+    __slots__ = ('fields', 'complexity', 'nodes')
+
+    def __init__(self, fields, complexity, nodes):
+        self.fields = fields
+        self.complexity = complexity
+        self.nodes = nodes
+
+
+def _is_string(node):
+    return isinstance(node, ast.JoinedStr) or (
+        isinstance(node, ast.Constant) and isinstance(node.value, str))
+
+
+@lru_cache(maxsize=_CACHE_SIZE)
+def analyse_formula(formula, names, functions):
+    """Return the FormulaAnalysis of formula
+
+    FormulaError is raised if formula can not be parsed, uses other names
+    or functions than the given ones or may be too expensive to evaluate.
+    The complexity is 'threshold' for range checks of a value, 'simple'
+    without function calls and 'complex' otherwise."""
+    expression = compile_formula(formula)
+    try:
+        tree = parse_expression(expression)
+    except SyntaxError as exception:
+        raise FormulaError('syntax', exception.msg)
+
+    nodes, calls = 0, False
+    stack = [(tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        nodes += 1
+        if nodes > MAX_NODES or depth > MAX_DEPTH:
+            raise FormulaError('complexity')
+        if isinstance(node, _UNSUPPORTED):
+            raise FormulaError('unsupported', type(node).__name__)
+        elif isinstance(node, ast.Name):
+            if node.id not in names and node.id not in functions:
+                raise FormulaError('name', node.id)
+        elif isinstance(node, ast.Attribute):
+            if node.attr.startswith('_'):
+                raise FormulaError('name', node.attr)
+        elif isinstance(node, ast.Call):
+            # Methods are checked as attributes
+            if (isinstance(node.func, ast.Name)
+                    and node.func.id not in functions):
+                raise FormulaError('function', node.func.id)
+            if _number(node) is None:
+                calls = True
+        elif isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Pow):
+                exponent = _number(node.right)
+                if exponent is None or abs(exponent) > MAX_POWER:
+                    raise FormulaError('expensive', ast.unparse(node))
+            elif isinstance(node.op, ast.Mult) and (
+                    _is_string(node.left) or _is_string(node.right)):
+                raise FormulaError('expensive', ast.unparse(node))
+        stack.extend((c, depth + 1) for c in ast.iter_child_nodes(node))
+
+    if threshold_interval(formula) is not None:
+        complexity = 'threshold'
+    elif calls:
+        complexity = 'complex'
+    else:
+        complexity = 'simple'
+    if expression_names(expression) <= {'record'}:
+        fields = record_fields((expression,))
+    else:
+        # The values of the other names can not be cached with the record
+        fields = None
+    return FormulaAnalysis(fields, complexity, nodes)
@@ -0,0 +1,97 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from trytond.config import config
+
+from .formula import evaluator_class
+
+__all__ = ['enabled', 'timer', 'log_quote', 'get_stats', 'reset_stats',
+    'instrumented_evaluator_class']
+logger = logging.getLogger(__name__)
+enabled = config.getboolean('carrier_formula', 'instrument', default=False)
+_counts = defaultdict(int)
+_durations = defaultdict(float)
+
+
+def add(name, duration=None, count=1):
+    _counts[name] += count
+    if duration is not None:
+        _durations[name] += duration
+
+
+@contextmanager
+def _timer(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - start)
+
+
+_null = nullcontext()
+
+
+def timer(name):
+    "Return a context manager timing its block under name when enabled"
+    if enabled:
+        return _timer(name)
+    return _null
+
+
+def get_stats():
+    "Return the count and the cumulated duration in seconds per name"
+    return {name: {
+            'count': count,
+            'duration': _durations.get(name),
+            } for name, count in _counts.items()}
+
+
+def reset_stats():
+    _counts.clear()
+    _durations.clear()
+
+
+@lru_cache(maxsize=None)
+def instrumented_evaluator_class():
+    "Return the InstrumentedFormulaEvaluator class"
+
+    class InstrumentedFormulaEvaluator(evaluator_class()):
+        "Formula evaluator counting and timing its evaluations"
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.evaluated = 0
+            self.duration = 0.
+
+        def evaluate(self, expression):
+            start = time.perf_counter()
+            try:
+                return super().evaluate(expression)
+            finally:
+                self.evaluated += 1
+                self.duration += time.perf_counter() - start
+    InstrumentedFormulaEvaluator.__qualname__ = 'InstrumentedFormulaEvaluator'
+    return InstrumentedFormulaEvaluator
+
+
+def __getattr__(name):
+    if name == 'InstrumentedFormulaEvaluator':
+        return instrumented_evaluator_class()
+    raise AttributeError(
+        "module '%s' has no attribute '%s'" % (__name__, name))
+
+
+def log_quote(carrier, line, evaluator):
+    "Record the evaluations of a quote"
+    add('quote')
+    add('evaluate', evaluator.duration, count=evaluator.evaluated)
+    logger.debug(
+        "carrier %s: %s formulas evaluated in %.6fs, matched line %s",
+        carrier.id, evaluator.evaluated, evaluator.duration,
+        line.id if line else None)
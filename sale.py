@@ -1,7 +1,18 @@
 # This file is part carrier_formula module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.pool import PoolMeta
+import hashlib
+from collections import defaultdict
+
+from trytond.config import config
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+# Number of sales requoted per queue task
+_requote_chunk = config.getint(
+    'carrier_formula', 'requote_chunk', default=100)
 
 
 class Sale(metaclass=PoolMeta):
@@ -17,3 +28,121 @@ class Sale(metaclass=PoolMeta):
         context = context.copy()
         context['record'] = self
         return context
+
+
+class SaleShipmentCost(metaclass=PoolMeta):
+    __name__ = 'sale.sale'
+    formula_shipment_band = fields.Char(
+        "Formula Shipment Band", readonly=True,
+        help="The band of the inputs of the formula shipment cost.")
+
+    @classmethod
+    def copy(cls, sales, default=None):
+        default = default.copy() if default is not None else {}
+        default.setdefault('formula_shipment_band', None)
+        return super().copy(sales, default=default)
+
+    @classmethod
+    def requote_formula_shipment_costs(cls, carriers=None):
+        """Requote the draft sales with a formula carrier and a shipment cost
+
+        The sales are split in chunks requoted by the queue."""
+        domain = [
+            ('state', '=', 'draft'),
+            ('carrier.carrier_cost_method', '=', 'formula'),
+            ('shipment_cost_method', '!=', None),
+            # Only quote adds the shipment cost line
+            ('lines.shipment_cost', '!=', None),
+            ]
+        if carriers is not None:
+            domain.append(('carrier', 'in', [c.id for c in carriers]))
+        sales = cls.search(domain, order=[('id', 'ASC')])
+        for sub_sales in grouped_slice(sales, _requote_chunk):
+            cls.__queue__.requote_formula_shipment_cost(list(sub_sales))
+
+    @classmethod
+    def requote_formula_shipment_cost(cls, sales):
+        "Requote the shipment cost of the sales with a formula carrier"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Line = pool.get('sale.line')
+
+        sales = [s for s in sales
+            if s.state == 'draft'
+            and s.shipment_cost_method
+            and s.carrier
+            and s.carrier.carrier_cost_method == 'formula'
+            and any(line.shipment_cost is not None for line in s.lines)]
+        carrier_sales = defaultdict(list)
+        for sale in sales:
+            carrier_sales[sale.carrier].append(sale)
+
+        # Only the sales whose inputs left their band are quoted
+        bands = {s.id: s.get_formula_shipment_band() for s in sales}
+        for carrier, c_sales in list(carrier_sales.items()):
+            c_sales = [s for s in c_sales
+                if not s.has_formula_shipment_cost(bands[s.id])]
+            if c_sales:
+                carrier_sales[carrier] = c_sales
+            else:
+                del carrier_sales[carrier]
+
+        # Quote all the sales of a carrier at once
+        prices = {}
+        Carrier.set_formula_totals_list(
+            [s for c_sales in carrier_sales.values() for s in c_sales])
+        for carrier, c_sales in carrier_sales.items():
+            [c_prices] = Carrier.compute_formula_prices([carrier], c_sales)
+            for sale, price in zip(c_sales, c_prices):
+                prices[(carrier.id, str(sale))] = price
+
+        removed = []
+        with Transaction().set_context(
+                formula_prices=prices, formula_bands=bands):
+            for sale in sales:
+                removed.extend(sale.set_shipment_cost())
+        Line.delete(removed)
+        cls.save(sales)
+
+    def get_formula_shipment_band(self):
+        """Return the band of the inputs of the formula shipment cost or None
+
+        The shipment cost stays the same as long as the band is the same."""
+        pool = Pool()
+        Date = pool.get('ir.date')
+        if (not self.carrier
+                or self.carrier.carrier_cost_method != 'formula'
+                or not self.shipment_cost_method
+                or not self.currency
+                or not any(line.quantity >= 0
+                    for line in self.lines if line.movable)):
+            return
+        with Transaction().set_context(
+                self._get_carrier_context(self.carrier)):
+            band = self.carrier.get_formula_band(self)
+        if band is not None:
+            # The cost is converted at the date of the sale or today
+            with Transaction().set_context(company=self.company.id):
+                today = Date.today()
+            band = (band, self.currency.id, self.sale_date or today)
+            return hashlib.sha1(repr(band).encode()).hexdigest()
+
+    def has_formula_shipment_cost(self, band):
+        "Return if the shipment cost line was quoted for the band"
+        return (band is not None
+            and band == self.formula_shipment_band
+            and any(line.type == 'line' and line.shipment_cost is not None
+                for line in self.lines))
+
+    def set_shipment_cost(self):
+        bands = Transaction().context.get('formula_bands', {})
+        if self.id in bands:
+            band = bands[self.id]
+        else:
+            band = self.get_formula_shipment_band()
+        # Keep the shipment cost line while no input crosses a boundary
+        if self.has_formula_shipment_cost(band):
+            return []
+        removed = super().set_shipment_cost()
+        self.formula_shipment_band = band
+        return removed
@@ -107,6 +107,9 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require={
+        'numpy': ['numpy'],
+        },
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
@@ -0,0 +1,255 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Simulation of a candidate price list on the done customer shipments
+
+Compare the shipment costs of the current price list of a carrier with a
+candidate snapshot and write the aggregated deltas as JSON:
+
+    python -m trytond.modules.carrier_formula.simulation \\
+        -d database carrier candidate.json [output]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import snapshot as snapshot_
+from .formula import compile_formula, record_fields
+
+__all__ = ['simulate', 'Simulation']
+_INPUT_TYPES = (
+    type(None), bool, int, float, Decimal, str, datetime.date)
+
+# The evaluators of the worker processes
+_evaluators = None
+
+
+def _init(*snapshots):
+    global _evaluators
+    _evaluators = [snapshot_.SnapshotEvaluator(s) for s in snapshots]
+
+
+def _quote(inputs):
+    "Return the rounded prices of each evaluator for the inputs"
+    columns = {}
+    for i, (values, totals) in enumerate(inputs):
+        for name, value in values.items():
+            columns.setdefault(name, [None] * len(inputs))[i] = value
+        for name, value in (totals or {}).items():
+            columns.setdefault(
+                'totals.' + name, [None] * len(inputs))[i] = value
+    prices = [[e.round(p) for p in e.quote_batch(columns, len(inputs))]
+        for e in _evaluators]
+    return list(zip(*prices))
+
+
+class Simulation(object):
+    "Aggregated deltas between the current and the candidate prices"
+
+    def __init__(self):
+        self.count = 0
+        self.unpriced = 0
+        self.current = Decimal(0)
+        self.candidate = Decimal(0)
+        self.increased = 0
+        self.decreased = 0
+        self.max_increase = Decimal(0)
+        self.max_decrease = Decimal(0)
+
+    def add(self, current, candidate):
+        self.count += 1
+        self.current += current
+        self.candidate += candidate
+        delta = candidate - current
+        if delta > 0:
+            self.increased += 1
+            self.max_increase = max(self.max_increase, delta)
+        elif delta < 0:
+            self.decreased += 1
+            self.max_decrease = min(self.max_decrease, delta)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'unpriced': self.unpriced,
+            'current': str(self.current),
+            'candidate': str(self.candidate),
+            'delta': str(self.candidate - self.current),
+            'increased': self.increased,
+            'decreased': self.decreased,
+            'unchanged': self.count - self.increased - self.decreased,
+            'max_increase': str(self.max_increase),
+            'max_decrease': str(self.max_decrease),
+            }
+
+
+def _input_fields(*snapshots):
+    "Return the record fields read by the snapshots"
+    expressions = []
+    for snapshot in snapshots:
+        for line in snapshot['lines']:
+            expressions.append(compile_formula(line['formula'] or ''))
+            if line.get('price_type') == 'formula':
+                expressions.append(compile_formula(line['price_formula']))
+            elif (line.get('price_type') == 'tiers'
+                    and '.' not in line['tier_field']):
+                expressions.append('record.%s' % line['tier_field'])
+    fields = record_fields(tuple(expressions))
+    if fields is None:
+        raise ValueError('The formulas do not only read record fields')
+    return fields
+
+
+def _shipment_record(shipment):
+    "Return the sale quoted for the shipment or None"
+    origin = getattr(shipment, 'origin', None)
+    if origin and origin.__name__ == 'sale.sale' and origin.carrier:
+        return origin
+
+
+def _shipment_inputs(carrier, shipments, fields, with_totals):
+    """Return the values and the totals of the record quoted for each shipment
+    or None if it is not quoted by the formulas
+
+    The totals of the records are computed together for each company."""
+    pool = Pool()
+    Carrier = pool.get('carrier')
+    transaction = Transaction()
+    records = [_shipment_record(s) for s in shipments]
+    companies = defaultdict(list)
+    for i, (shipment, record) in enumerate(zip(shipments, records)):
+        if record:
+            companies[shipment.company.id].append(i)
+
+    inputs = [None] * len(shipments)
+    for company_id, positions in companies.items():
+        with transaction.set_context(company=company_id):
+            Carrier.set_formula_totals_list([records[i] for i in positions])
+            for i in positions:
+                record = records[i]
+                values = {}
+                for name in fields:
+                    value = getattr(record, name)
+                    if not isinstance(value, _INPUT_TYPES):
+                        raise ValueError(
+                            'The field "%s" can not be simulated' % name)
+                    values[name] = value
+                if with_totals:
+                    totals = carrier.get_formula_line_totals(record)
+                else:
+                    totals = None
+                inputs[i] = (values, totals)
+    return inputs
+
+
+def simulate(carrier, candidate, domain=None, chunk=None, processes=None):
+    """Return the Simulation of the candidate snapshot against the current
+    price list of carrier on the done customer shipments
+
+    The shipments are read by chunks of increasing ids and their inputs are
+    built as for get_sale_price. The prices are evaluated by a pool of
+    processes or in the current process if processes is 0."""
+    pool = Pool()
+    Shipment = pool.get('stock.shipment.out')
+
+    current = carrier.export_formula_snapshot()
+    snapshots = (current, candidate)
+    fields = _input_fields(*snapshots)
+    with_totals = any('totals' in s['names'] for s in snapshots)
+    chunk = chunk or config.getint(
+        'carrier_formula', 'simulation_chunk', default=1000)
+    domain = [
+        ('carrier', '=', carrier.id),
+        ('state', '=', 'done'),
+        ] + list(domain or [])
+
+    simulation = Simulation()
+
+    def add(prices):
+        for current, candidate in prices:
+            simulation.add(current, candidate)
+
+    if processes == 0:
+        _init(*snapshots)
+        executor = None
+    else:
+        processes = processes or os.cpu_count() or 1
+        executor = ProcessPoolExecutor(processes,
+            initializer=_init, initargs=snapshots)
+    try:
+        # Keep at most one chunk per process waiting
+        pending = []
+        last = 0
+        while True:
+            shipments = Shipment.search(domain + [('id', '>', last)],
+                order=[('id', 'ASC')], limit=chunk)
+            if not shipments:
+                break
+            last = shipments[-1].id
+            inputs = []
+            for input_ in _shipment_inputs(
+                    carrier, shipments, fields, with_totals):
+                if input_ is None:
+                    simulation.unpriced += 1
+                else:
+                    inputs.append(input_)
+            if executor:
+                pending.append(executor.submit(_quote, inputs))
+                while len(pending) > processes:
+                    add(pending.pop(0).result())
+            else:
+                add(_quote(inputs))
+        for future in pending:
+            add(future.result())
+    finally:
+        if executor:
+            executor.shutdown()
+    return simulation
+
+
+def main(database, carrier_id, candidate, output=None, processes=None):
+    with open(candidate) as fp:
+        candidate = snapshot_.load(fp)
+    Pool(database).init()
+    with Transaction().start(database, 0, readonly=True):
+        Carrier = Pool().get('carrier')
+        simulation = simulate(
+            Carrier(carrier_id), candidate, processes=processes)
+        result = simulation.to_dict()
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--config', dest='configfile',
+        help="the trytond configuration file")
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('-p', '--processes', type=int,
+        help="the number of evaluation processes, 0 to evaluate in process")
+    parser.add_argument('carrier', type=int)
+    parser.add_argument('candidate',
+        help="the JSON snapshot of the candidate price list")
+    parser.add_argument('output', nargs='?',
+        help="the JSON file to write the results")
+    args = parser.parse_args()
+    # The configuration must be loaded before importing trytond
+    if (args.configfile
+            and os.environ.get('TRYTOND_CONFIG') != args.configfile):
+        os.environ['TRYTOND_CONFIG'] = args.configfile
+        os.execv(sys.executable,
+            [sys.executable, '-m', __spec__.name] + sys.argv[1:])
+    main(args.database, args.carrier, args.candidate, args.output,
+        args.processes)
@@ -0,0 +1,131 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Quoting from price list snapshots without pool nor transaction
+
+A snapshot is exported by Carrier.export_formula_snapshot and contains
+everything needed to quote with the same result as compute_formula_price
+from a plain dictionary of record values."""
+import json
+from decimal import Decimal
+
+from .formula import (compile_formula, threshold_index, tiers_price,
+    to_decimal, evaluator_class, FormulaRecord, FUNCTIONS)
+from .vectorize import column_rows, first_match
+
+__all__ = ['VERSION', 'dump', 'load', 'SnapshotEvaluator']
+VERSION = 1
+
+
+def dump(snapshot, fp):
+    "Write snapshot as JSON to the file object fp"
+    json.dump(snapshot, fp, indent=1, sort_keys=True)
+
+
+def load(fp):
+    "Return the snapshot read from the file object fp"
+    snapshot = json.load(fp)
+    if snapshot.get('version') != VERSION:
+        raise ValueError(
+            'Unsupported snapshot version "%s"' % snapshot.get('version'))
+    return snapshot
+
+
+class SnapshotEvaluator(object):
+    "Quote the prices of a price list snapshot"
+
+    def __init__(self, snapshot, functions=None):
+        if snapshot.get('version') != VERSION:
+            raise ValueError(
+                'Unsupported snapshot version "%s"' % snapshot.get('version'))
+        if functions is None:
+            functions = FUNCTIONS
+        self.functions = dict(functions)
+        names = set(snapshot['names']) - {'record', 'totals'}
+        missing = set(snapshot['functions']) - set(self.functions)
+        if names or missing:
+            raise ValueError('Snapshot requires "%s"'
+                % ', '.join(sorted(names | missing)))
+        self.carrier = snapshot['carrier']
+        self.digits = snapshot['digits']
+        lines = snapshot['lines']
+        self.formulas = tuple(line['formula'] or '' for line in lines)
+        self.expressions = [compile_formula(f) for f in self.formulas]
+        self.lines = [{
+                'price_type': line.get('price_type') or 'fixed',
+                'price': Decimal(line['price']),
+                'price_formula': compile_formula(
+                    line.get('price_formula') or ''),
+                'tier_field': line.get('tier_field'),
+                'tiers': [(Decimal(s), Decimal(r))
+                    for s, r in line.get('tiers') or []],
+                } for line in lines]
+
+    def find(self, evaluator):
+        "Return the position of the first line with a true formula"
+        start = 0
+        index = threshold_index(self.formulas)
+        if index:
+            value = evaluator.resolve(index.path)
+            if (isinstance(value, (int, float, Decimal))
+                    and value == value):
+                position = index.lookup(value)
+                if position is not None:
+                    return position
+                start = index.size
+        for position in range(start, len(self.expressions)):
+            if evaluator.evaluate(self.expressions[position]):
+                return position
+
+    def quote(self, values, model='sale.sale', totals=None):
+        """Return the price for the record values and the totals of its lines
+
+        The price is not rounded as for compute_formula_price."""
+        evaluator = evaluator_class()(
+            names={
+                'record': FormulaRecord(model, values),
+                'totals': FormulaRecord('totals', totals or {}),
+                },
+            functions=self.functions)
+        return self._price(self.find(evaluator), evaluator)
+
+    def quote_batch(self, columns, size, model='sale.sale'):
+        """Return the prices for the rows of the columns of values
+
+        The columns are keyed by record field name or by path for the totals
+        like "totals.weight". The formulas are evaluated over the columns with
+        NumPy when available."""
+        positions = first_match(self.formulas, columns, size, self.functions)
+        prices = []
+        rows = None
+        for i, position in enumerate(positions):
+            if (position is not None
+                    and self.lines[position]['price_type'] != 'fixed'):
+                if rows is None:
+                    rows = column_rows(columns, size, model)
+                evaluator = evaluator_class()(
+                    names=rows[i], functions=self.functions)
+            else:
+                evaluator = None
+            prices.append(self._price(position, evaluator))
+        return prices
+
+    def _price(self, position, evaluator):
+        if position is None:
+            return Decimal(0)
+        line = self.lines[position]
+        if line['price_type'] == 'formula':
+            return to_decimal(evaluator.evaluate(line['price_formula']))
+        elif line['price_type'] == 'tiers':
+            field = line['tier_field'] or ''
+            if '.' in field:
+                path = tuple(field.split('.'))
+            else:
+                path = ('record', field)
+            value = evaluator.resolve(path)
+            return tiers_price(line['price'], line['tiers'], value)
+        return line['price']
+
+    def round(self, price):
+        "Round price to the digits of the currency"
+        return price.quantize(Decimal(10) ** -Decimal(self.digits))
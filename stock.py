@@ -1,31 +1,16 @@
 # This file is part carrier_formula module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from decimal import Decimal
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 
+from .aggregate import aggregate_moves
+from .tools import company_currency
+
 __all__ = ['ShipmentIn', 'ShipmentOut']
-_ZERO = Decimal(0)
 
 def _formula_amount(lines, company):
-    pool = Pool()
-    Move = pool.get('stock.move')
-    Currency = pool.get('currency.currency')
-
-    amount = _ZERO
-    for line in lines or []:
-        unit_price = getattr(line, 'unit_price',
-            Move.default_unit_price() if hasattr(Move, 'default_unit_price')
-            else _ZERO)
-        currency = getattr(line, 'currency',
-            Move.default_currency() if hasattr(Move, 'default_currency')
-            else None)
-        if currency:
-            unit_price = Currency.compute(currency, unit_price,
-                company.currency, round=False)
-        amount += (unit_price or _ZERO) * Decimal(str(line.quantity or 0))
-    return amount
+    return aggregate_moves(lines, company)['amount']
 
 
 class ShipmentIn(metaclass=PoolMeta):
@@ -42,7 +27,7 @@ class ShipmentIn(metaclass=PoolMeta):
         company = Company(Transaction().context['company'])
         context['record'] = self
         context['amount'] = _formula_amount(self.incoming_moves, company)
-        context['currency'] = company.currency.id
+        context['currency'] = company_currency(company.id)
         return context
 
 
@@ -65,5 +50,5 @@ class ShipmentOut(metaclass=PoolMeta):
         company = Company(Transaction().context['company'])
         if hasattr(self, 'inventory_moves') and self.inventory_moves:
             context['amount'] = _formula_amount(self.inventory_moves, company)
-        context['currency'] = company.currency.id
+        context['currency'] = company_currency(company.id)
         return context
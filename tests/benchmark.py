@@ -0,0 +1,304 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Benchmark of the carrier formula quoting
+
+Run against the database configured for the tests (SQLite by default)
+and write the timings as JSON to the output file or to stdout. The cold
+start timings of importing and registering the module and of the first
+evaluation are measured in new interpreters:
+
+    python -m trytond.modules.carrier_formula.tests.benchmark [output]
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import platform
+import subprocess
+import sys
+import time
+from decimal import Decimal
+
+import trytond
+from trytond import backend
+from trytond.modules import get_module_info
+from trytond.modules.carrier_formula.stock import _formula_amount
+from trytond.modules.company.tests import create_company, set_company
+from trytond.pool import Pool
+from trytond.tests.test_tryton import activate_module, with_transaction
+from trytond.transaction import Transaction
+
+MODULES = ['carrier_formula', 'sale_shipment_cost', 'purchase_shipment_cost']
+PRICE_LIST_SIZES = [10, 100, 1000]
+RECORD_SIZES = [10, 100, 1000]
+FORMULAS = {
+    'threshold': 'getattr(record, "total_amount") > %s',
+    'expression': 'round(record.total_amount) > %s',
+    }
+REPEAT = 20
+COLD_START_REPEAT = 5
+# Run in a new interpreter with the dependencies already imported like a
+# worker loading the modules
+COLD_START = """
+import json
+import sys
+import time
+
+import trytond.modules.carrier
+import trytond.modules.company
+import trytond.modules.currency
+import trytond.modules.stock
+import trytond.modules.sale
+
+start = time.perf_counter()
+import trytond.modules.carrier_formula as module
+imported = time.perf_counter()
+module.register()
+registered = time.perf_counter()
+from trytond.modules.carrier_formula.formula import (
+    FUNCTIONS, FormulaRecord, compile_formula, evaluator_class)
+evaluator_class()(names={
+        'record': FormulaRecord('sale.sale', {'total_amount': 10}),
+        }, functions=FUNCTIONS).evaluate(
+    compile_formula('record.total_amount > 5'))
+evaluated = time.perf_counter()
+json.dump({
+        'import': imported - start,
+        'register': registered - imported,
+        'first_evaluation': evaluated - registered,
+        }, sys.stdout)
+"""
+
+
+def summary(timings):
+    "Return the summary of the timings in seconds"
+    return {
+        'calls': len(timings),
+        'min': min(timings),
+        'max': max(timings),
+        'mean': sum(timings) / len(timings),
+        }
+
+
+def timeit(function, repeat=REPEAT):
+    """Return the timings in seconds of calling function repeat times
+
+    The first call is also reported alone as the next calls may be served by
+    the caches of the transaction."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return dict(summary(timings), first=timings[0])
+
+
+def cold_start(repeat=COLD_START_REPEAT):
+    """Return the timings of importing and registering the module and of the
+    first evaluation in new interpreters"""
+    timings = {}
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', COLD_START],
+            check=True, capture_output=True, text=True).stdout
+        for name, duration in json.loads(output).items():
+            timings.setdefault(name, []).append(duration)
+    return {name: summary(t) for name, t in timings.items()}
+
+
+def create_carrier(company, size, formula):
+    "Create a formula carrier with size price list lines"
+    pool = Pool()
+    Carrier = pool.get('carrier')
+    Party = pool.get('party.party')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': 'Carrier',
+                'type': 'service',
+                'salable': True,
+                'default_uom': unit.id,
+                'sale_uom': unit.id,
+                'list_price': Decimal(3),
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+    party, = Party.create([{'name': 'Carrier'}])
+    # Thresholds are decreasing so the first match is the middle line for a
+    # total amount of size / 2
+    carrier, = Carrier.create([{
+                'party': party.id,
+                'carrier_product': product.id,
+                'carrier_cost_method': 'formula',
+                'formula_currency': company.currency.id,
+                'formula_price_list': [('create', [{
+                                'sequence': i,
+                                'formula': formula % (size - i),
+                                'price': Decimal(size - i),
+                                } for i in range(size)])],
+                }])
+    return carrier
+
+
+def create_document(Model, company, carrier, size):
+    "Create a sale or a purchase with size lines"
+    pool = Pool()
+    Party = pool.get('party.party')
+
+    party, = Party.create([{'name': 'Party'}])
+    values = {
+        'party': party.id,
+        'company': company.id,
+        'currency': company.currency.id,
+        'lines': [('create', [{
+                        'type': 'line',
+                        'description': 'Line %s' % i,
+                        'quantity': 1,
+                        'unit_price': Decimal(1),
+                        } for i in range(size)])],
+        }
+    if 'carrier' in Model._fields:
+        values['carrier'] = carrier.id
+    document, = Model.create([values])
+    return document
+
+
+def create_moves(company, size):
+    "Create size stock moves"
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': 'Goods',
+                'type': 'goods',
+                'default_uom': unit.id,
+                'list_price': Decimal(10),
+                'products': [('create', [{}])],
+                }])
+    product, = template.products
+    storage, = Location.search([('code', '=', 'STO')])
+    customer, = Location.search([('code', '=', 'CUS')])
+    return Move.create([{
+                'product': product.id,
+                'unit': unit.id,
+                'quantity': 1,
+                'from_location': storage.id,
+                'to_location': customer.id,
+                'unit_price': Decimal(10),
+                'currency': company.currency.id,
+                'company': company.id,
+                } for _ in range(size)])
+
+
+@with_transaction()
+def run():
+    pool = Pool()
+    Carrier = pool.get('carrier')
+    Sale = pool.get('sale.sale')
+    Move = pool.get('stock.move')
+
+    results = []
+
+    def add(name, size, timings, **extra):
+        results.append(dict(name=name, size=size, **extra, **timings))
+
+    company = create_company()
+    with set_company(company):
+        carriers = []
+        for kind, formula in FORMULAS.items():
+            for size in PRICE_LIST_SIZES:
+                carrier = create_carrier(company, size, formula)
+                carriers.append(carrier)
+                amount = Decimal(size) / 2
+                record = Sale(total_amount=amount)
+                add('compute_formula_price', size, timeit(
+                        lambda: carrier.compute_formula_price(record)),
+                    formula=kind)
+
+                with Transaction().set_context(
+                        carrier=carrier.id,
+                        record={'total_amount': amount},
+                        record_model='sale.sale'):
+                    add('get_sale_price.cart', size, timeit(
+                            carrier.get_sale_price),
+                        formula=kind)
+
+        add('get_sale_prices', len(carriers), timeit(
+                lambda: Carrier.get_sale_prices(
+                    carriers, {'total_amount': Decimal(50)})))
+
+        carrier = create_carrier(company, 100, FORMULAS['threshold'])
+        for size in RECORD_SIZES:
+            sale = create_document(Sale, company, carrier, size)
+            with Transaction().set_context(record=str(sale)):
+                add('get_sale_price.sale', size, timeit(
+                        carrier.get_sale_price),
+                    price_list=100)
+
+        try:
+            Purchase = pool.get('purchase.purchase')
+        except KeyError:
+            pass
+        else:
+            purchases = []
+            for size in RECORD_SIZES:
+                purchase = create_document(Purchase, company, carrier, size)
+                purchases.append(purchase)
+                with Transaction().set_context(record=str(purchase)):
+                    add('get_purchase_price.purchase', size, timeit(
+                            carrier.get_purchase_price),
+                        price_list=100)
+            add('get_purchase_prices', len(purchases), timeit(
+                    lambda: Carrier.get_purchase_prices(
+                        Purchase.browse(purchases))),
+                price_list=100)
+
+        for size in RECORD_SIZES:
+            moves = create_moves(company, size)
+            add('_formula_amount.stored', size, timeit(
+                    lambda: _formula_amount(Move.browse(moves), company)))
+            unsaved = [Move(
+                    quantity=1, unit_price=Decimal(10),
+                    currency=company.currency) for _ in range(size)]
+            add('_formula_amount.unsaved', size, timeit(
+                    lambda: _formula_amount(unsaved, company)))
+    return results
+
+
+def main(output=None):
+    modules = list(MODULES)
+    if importlib.util.find_spec('trytond.modules.purchase'):
+        modules.append('purchase')
+    activate_module(modules)
+    report = {
+        'module': 'carrier_formula',
+        'version': get_module_info('carrier_formula').get('version'),
+        'trytond': trytond.__version__,
+        'python': platform.python_version(),
+        'backend': backend.name,
+        'date': datetime.datetime.now().isoformat(),
+        'repeat': REPEAT,
+        'results': run(),
+        }
+    for name, timings in cold_start().items():
+        report['results'].append(
+            dict(name='cold_start.' + name, size=1, **timings))
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', nargs='?',
+        help="the JSON file to write the results")
+    args = parser.parse_args()
+    main(args.output)
@@ -1,14 +1,882 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+from decimal import Decimal
+from unittest.mock import patch
+
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.modules.currency.tests import add_currency_rate, create_currency
+from trytond.modules.carrier_formula.exceptions import (
+    FormulaPriceError, FormulaSnapshotError, FormulaValidationError)
+from trytond.modules.carrier_formula.formula import (
+    analyse_formula, compile_formula, threshold_index, tiers_price,
+    to_decimal, FormulaError, FormulaEvaluator, FormulaRecord, FUNCTIONS)
+from trytond.modules.carrier_formula.simulation import Simulation
+from trytond.modules.carrier_formula.snapshot import SnapshotEvaluator
+from trytond.modules.carrier_formula.stock import _formula_amount
+from trytond.modules.carrier_formula.vectorize import first_match
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+
+def create_product(type='goods', list_price=Decimal(10), weight=None):
+    "Create a salable product"
+    pool = Pool()
+    Category = pool.get('product.category')
+    Template = pool.get('product.template')
+    Uom = pool.get('product.uom')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    # Without taxes
+    category, = Category.create([{
+                'name': 'Account Category',
+                'accounting': True,
+                }])
+    values = {
+        'name': 'Product',
+        'account_category': category.id,
+        'type': type,
+        'salable': True,
+        'default_uom': unit.id,
+        'sale_uom': unit.id,
+        'list_price': list_price,
+        'products': [('create', [{}])],
+        }
+    if weight is not None:
+        kilogram, = Uom.search([('name', '=', 'Kilogram')])
+        values['weight'] = weight
+        values['weight_uom'] = kilogram.id
+    template, = Template.create([values])
+    product, = template.products
+    return product
+
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+def create_carrier(company, prices, formula='record.total_amount > %s',
+        **values):
+    """Create a formula carrier with a price list line per threshold and
+    price of prices"""
+    pool = Pool()
+    Carrier = pool.get('carrier')
+    Party = pool.get('party.party')
+
+    party, = Party.create([{'name': 'Carrier'}])
+    values.setdefault('carrier_cost_method', 'formula')
+    carrier, = Carrier.create([{
+                'party': party.id,
+                'carrier_product': create_product(
+                    type='service', list_price=Decimal(3)).id,
+                'formula_currency': company.currency.id,
+                'formula_price_list': [('create', [{
+                                'sequence': i,
+                                'formula': formula % threshold,
+                                'price': price,
+                                } for i, (threshold, price) in enumerate(
+                                prices)])],
+                **values,
+                }])
+    return carrier
+
+
+def create_sale(company, carrier, quantities, product=None, **values):
+    "Create a draft sale with a line per quantity at a unit price of 10"
+    pool = Pool()
+    Party = pool.get('party.party')
+    Sale = pool.get('sale.sale')
+
+    party, = Party.create([{'name': 'Customer'}])
+    if product is None:
+        product = create_product()
+    sale, = Sale.create([{
+                'party': party.id,
+                'company': company.id,
+                'currency': company.currency.id,
+                'carrier': carrier.id if carrier else None,
+                'lines': [('create', [{
+                                'type': 'line',
+                                'product': product.id,
+                                'unit': product.default_uom.id,
+                                'quantity': quantity,
+                                'unit_price': Decimal(10),
+                                } for quantity in quantities])],
+                **values,
+                }])
+    return sale
 
 
 class CarrierFormulaTestCase(CompanyTestMixin, ModuleTestCase):
     'Test CarrierFormula module'
     module = 'carrier_formula'
+    extras = [
+        'sale_shipment_cost', 'purchase_shipment_cost',
+        'product_measurements']
+
+    def test_threshold_index(self):
+        "Test threshold index matches sequential evaluation"
+        formulas = (
+            'getattr(record, "total_amount") >= 250',
+            'record.total_amount >= 150',
+            '0 <= record.total_amount < 20.5',
+            'record.total_amount > 0',
+            )
+        index = threshold_index(formulas)
+        self.assertEqual(index.path, ('record', 'total_amount'))
+        self.assertEqual(index.size, len(formulas))
+
+        class Record:
+            pass
+        record = Record()
+        evaluator = FormulaEvaluator(
+            names={'record': record}, functions={'Decimal': Decimal})
+        for value in map(Decimal, [
+                    '-1', '0', '10', '20.5', '100', '150', '249.99', '250',
+                    '1000']):
+            record.total_amount = value
+            expected = next((i for i, f in enumerate(formulas)
+                    if evaluator.evaluate(compile_formula(f))), None)
+            self.assertEqual(index.lookup(value), expected, msg=value)
+
+        self.assertEqual(
+            index.region(Decimal(30)), index.region(Decimal(149)))
+        self.assertNotEqual(
+            index.region(Decimal(149)), index.region(Decimal(150)))
+        self.assertNotEqual(
+            index.region(Decimal(150)), index.region(Decimal(151)))
+
+    def test_threshold_index_fallback(self):
+        "Test threshold index stops at other formulas"
+        index = threshold_index((
+                'record.weight > 10', 'record.total_amount > 0'))
+        self.assertEqual(index.size, 1)
+        self.assertIsNone(threshold_index(('round(record.weight) > 10',)))
+
+    def test_analyse_formula(self):
+        "Test analyse formula"
+        names = frozenset(['record'])
+        functions = frozenset(['Decimal', 'round'])
+        for formula, fields, complexity in [
+                ('getattr(record, "total_amount") > 0',
+                    {'total_amount'}, 'threshold'),
+                ('record.weight * 2 > 10', {'weight'}, 'simple'),
+                ('round(record.weight) > 10', {'weight'}, 'complex'),
+                ('record.country.code in ("ES", "PT")', {'country'}, 'simple'),
+                ('record.party.name.startswith("A")', {'party'}, 'complex'),
+                ]:
+            with self.subTest(formula=formula):
+                analysis = analyse_formula(formula, names, functions)
+                self.assertEqual(analysis.fields, fields)
+                self.assertEqual(analysis.complexity, complexity)
+
+    def test_formula_evaluator_containers(self):
+        "Test formula evaluator with literal containers"
+        evaluator = FormulaEvaluator(names={'record': FormulaRecord(
+                    'sale.sale', {'code': 'ES'})})
+        for formula, result in [
+                ('record.code in ("ES", "PT")', True),
+                ('record.code in ["FR"]', False),
+                ('record.code in {"ES"}', True),
+                ]:
+            with self.subTest(formula=formula):
+                self.assertEqual(
+                    evaluator.evaluate(compile_formula(formula)), result)
+
+    def test_analyse_formula_invalid(self):
+        "Test analyse invalid formula"
+        names = frozenset(['record'])
+        functions = frozenset(['Decimal', 'round'])
+        for formula, kind in [
+                ('record.weight >', 'syntax'),
+                ('weight > 10', 'name'),
+                ('record.__class__', 'name'),
+                ('max(record.weight, 1)', 'function'),
+                ('[w for w in record.weights]', 'unsupported'),
+                ('{"a": record.weight}', 'unsupported'),
+                ('10 ** record.weight', 'expensive'),
+                ('"x" * 1000000', 'expensive'),
+                (' + '.join(['record.weight'] * 200), 'complexity'),
+                ('record.code in (%s)' % ', '.join(['"x"'] * 300),
+                    'complexity'),
+                ]:
+            with self.subTest(formula=formula):
+                with self.assertRaises(FormulaError) as cm:
+                    analyse_formula(formula, names, functions)
+                self.assertEqual(cm.exception.kind, kind)
+
+    def test_snapshot_evaluator(self):
+        "Test snapshot evaluator"
+        evaluator = SnapshotEvaluator({
+                'version': 1,
+                'carrier': 1,
+                'digits': 2,
+                'names': ['record'],
+                'functions': ['Decimal', 'round'],
+                'lines': [{
+                        'id': 1,
+                        'formula': 'record.total_amount > 100',
+                        'price': '0',
+                        }, {
+                        'id': 2,
+                        'formula': 'round(record.weight) > 10',
+                        'price': '20.5',
+                        }, {
+                        'id': 3,
+                        'formula': 'getattr(record, "total_amount") > 0',
+                        'price': '10',
+                        }],
+                })
+        for values, price in [
+                ({'total_amount': Decimal(150), 'weight': 20}, Decimal(0)),
+                ({'total_amount': Decimal(50), 'weight': 20}, Decimal('20.5')),
+                ({'total_amount': Decimal(50), 'weight': 5}, Decimal(10)),
+                ({'total_amount': Decimal(0), 'weight': 5}, Decimal(0)),
+                ]:
+            with self.subTest(values=values):
+                self.assertEqual(evaluator.quote(values), price)
+        self.assertEqual(evaluator.round(Decimal('1.005')), Decimal('1.00'))
+
+    def test_tiers_price(self):
+        "Test tiers price"
+        tiers = [(Decimal(50), Decimal('0.5')), (Decimal(10), Decimal(1))]
+        for value, price in [
+                (None, Decimal(5)),
+                (5, Decimal(5)),
+                (10, Decimal(5)),
+                (Decimal(20), Decimal(15)),
+                (60.0, Decimal(50)),
+                ]:
+            with self.subTest(value=value):
+                self.assertEqual(tiers_price(Decimal(5), tiers, value), price)
+
+    def test_to_decimal(self):
+        "Test to decimal"
+        self.assertEqual(to_decimal(1.1), Decimal('1.1'))
+        self.assertEqual(to_decimal(2), Decimal(2))
+        for value in [None, True]:
+            with self.subTest(value=value):
+                with self.assertRaises(TypeError):
+                    to_decimal(value)
+
+    def test_snapshot_evaluator_price_type(self):
+        "Test snapshot evaluator with price types"
+        evaluator = SnapshotEvaluator({
+                'version': 1,
+                'carrier': 1,
+                'digits': 2,
+                'names': ['record'],
+                'functions': ['Decimal', 'round'],
+                'lines': [{
+                        'id': 1,
+                        'formula': 'record.total_amount > 100',
+                        'price_type': 'formula',
+                        'price': '0',
+                        'price_formula': 'record.total_amount * 0.1',
+                        }, {
+                        'id': 2,
+                        'formula': 'record.total_amount > 0',
+                        'price_type': 'tiers',
+                        'price': '5',
+                        'tier_field': 'totals.weight',
+                        'tiers': [['10', '1']],
+                        }],
+                })
+        self.assertEqual(
+            evaluator.quote({'total_amount': Decimal(150)}),
+            Decimal(15))
+        self.assertEqual(
+            evaluator.quote({'total_amount': Decimal(50)},
+                totals={'weight': Decimal(12)}),
+            Decimal(7))
+
+    def test_snapshot_evaluator_missing_function(self):
+        "Test snapshot evaluator with missing function"
+        with self.assertRaises(ValueError):
+            SnapshotEvaluator({
+                    'version': 1,
+                    'carrier': 1,
+                    'digits': 2,
+                    'names': ['record'],
+                    'functions': ['Decimal', 'round', 'max'],
+                    'lines': [],
+                    })
+
+    def test_first_match(self):
+        "Test first match over columns"
+        formulas = [
+            'record.total_amount > 100 and totals.weight < 5',
+            'round(record.total_amount) >= 10',
+            'record.total_amount * 2 + 1 > 0.5',
+            'record.total_amount / 0 > 1',
+            ]
+        columns = {
+            'total_amount': [
+                Decimal(150), Decimal(150), Decimal('9.6'), Decimal(0)],
+            'totals.weight': [1., 10., 0., 0.],
+            }
+        self.assertEqual(
+            first_match(formulas, columns, 4), [0, 1, 1, 2])
+
+    def test_simulation(self):
+        "Test simulation aggregates"
+        simulation = Simulation()
+        for current, candidate in [
+                (Decimal(10), Decimal(12)),
+                (Decimal(10), Decimal(7)),
+                (Decimal(5), Decimal(5)),
+                ]:
+            simulation.add(current, candidate)
+        self.assertEqual(simulation.to_dict(), {
+                'count': 3,
+                'unpriced': 0,
+                'current': '25',
+                'candidate': '24',
+                'delta': '-1',
+                'increased': 1,
+                'decreased': 1,
+                'unchanged': 1,
+                'max_increase': '2',
+                'max_decrease': '-3',
+                })
+
+    @with_transaction()
+    def test_formula_totals_modified(self):
+        "Test formula totals are recomputed after a modification"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+
+        company = create_company()
+        with set_company(company):
+            sale = create_sale(company, None, [1])
+            self.assertEqual(
+                Carrier.get_formula_totals(Sale(sale.id)),
+                (Decimal(10), Decimal(0)))
+
+            line, = Line.create([{
+                        'sale': sale.id,
+                        'type': 'line',
+                        'description': 'Line',
+                        'quantity': 1,
+                        'unit_price': Decimal(5),
+                        }])
+            self.assertEqual(
+                Carrier.get_formula_totals(Sale(sale.id)),
+                (Decimal(15), Decimal(0)))
+
+            Line.write([line], {'unit_price': Decimal(20)})
+            self.assertEqual(
+                Carrier.get_formula_totals(Sale(sale.id)),
+                (Decimal(30), Decimal(0)))
+
+    @with_transaction()
+    def test_formula_amount(self):
+        "Test formula amount of stored and unsaved moves in many currencies"
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+
+        company = create_company()
+        euro = create_currency('eur')
+        add_currency_rate(euro, 2)
+        with set_company(company):
+            product = create_product()
+            storage, = Location.search([('code', '=', 'STO')])
+            customer, = Location.search([('code', '=', 'CUS')])
+            moves = [Move(
+                        from_location=storage,
+                        to_location=customer,
+                        product=product,
+                        unit=product.default_uom,
+                        quantity=quantity,
+                        unit_price=unit_price,
+                        currency=currency,
+                        company=company)
+                for quantity, unit_price, currency in [
+                    (2, Decimal(10), company.currency),
+                    (3, Decimal(4), euro),
+                    (1, Decimal('2.5'), euro),
+                    (4, Decimal(3), company.currency),
+                    ]]
+            Move.save(moves[:2])
+            moves = Move.browse(moves[:2]) + moves[2:]
+            expected = sum(Currency.compute(
+                    m.currency, Decimal(str(m.quantity)) * m.unit_price,
+                    company.currency, round=False) for m in moves)
+
+            self.assertEqual(_formula_amount(moves, company), expected)
+            self.assertEqual(_formula_amount(moves[:2], company),
+                Decimal(20) + Decimal(6))
+            self.assertEqual(_formula_amount(moves[2:], company),
+                Decimal('1.25') + Decimal(12))
+            self.assertEqual(_formula_amount([], company), Decimal(0))
+
+    @with_transaction()
+    def test_formula_quote_cache(self):
+        "Test quote cache is cleared by a change of the price list"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Sale = pool.get('sale.sale')
+        PriceList = pool.get('carrier.formula_price_list')
+        Tier = pool.get('carrier.formula_price_list.tier')
+
+        company = create_company()
+        with set_company(company), patch(
+                'trytond.modules.carrier_formula.carrier'
+                '._quote_cache_duration', 3600):
+            carrier = create_carrier(
+                company, [(100, Decimal(5)), (0, Decimal(10))])
+            sale = create_sale(company, carrier, [1])
+
+            def quote():
+                prices, = Carrier.compute_formula_prices(
+                    [Carrier(carrier.id)], [Sale(sale.id)])
+                return prices[0]
+
+            self.assertEqual(quote(), Decimal(10))
+            hit = Carrier.get_formula_quote_cache_stats()['hit']
+            self.assertEqual(quote(), Decimal(10))
+            self.assertEqual(
+                Carrier.get_formula_quote_cache_stats()['hit'], hit + 1)
+
+            _, line = Carrier(carrier.id).formula_price_list
+            PriceList.write([line], {'price': Decimal(7)})
+            self.assertEqual(quote(), Decimal(7))
+
+            PriceList.write([line], {
+                    'price_type': 'tiers',
+                    'tier_field': 'total_amount',
+                    'tiers': [('create', [{
+                                    'start': Decimal(0),
+                                    'rate': Decimal(1),
+                                    }])],
+                    })
+            self.assertEqual(quote(), Decimal(17))
+
+            tier, = PriceList(line.id).tiers
+            Tier.write([tier], {'rate': Decimal(2)})
+            self.assertEqual(quote(), Decimal(27))
+
+            Tier.delete([tier])
+            self.assertEqual(quote(), Decimal(7))
+
+            Carrier.write([Carrier(carrier.id)], {
+                    'formula_price_list': [('delete', [line.id])],
+                    })
+            self.assertEqual(quote(), Decimal(0))
+
+    @with_transaction()
+    def test_formula_match_criteria(self):
+        "Test price list lines are filtered by their match criteria"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Sale = pool.get('sale.sale')
+        PriceList = pool.get('carrier.formula_price_list')
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [
+                    (100, Decimal(1)), (0, Decimal(2)),
+                    (100, Decimal(3)), (0, Decimal(4)),
+                    (0, Decimal(5))])
+            # The tier field is used as a criteria of the lines
+            lines = carrier.formula_price_list
+            PriceList.write(list(lines[:2]), {'tier_field': 'weight'})
+            PriceList.write(list(lines[2:4]), {'tier_field': 'total_amount'})
+            carrier = Carrier(carrier.id)
+            lines = list(carrier.formula_price_list)
+
+            self.assertEqual(
+                carrier._get_formula_candidates(
+                    lines, {'tier_field': 'total_amount'}),
+                lines[2:])
+            self.assertEqual(
+                carrier._get_formula_candidates(lines, {'tier_field': None}),
+                lines[4:])
+            self.assertEqual(carrier._get_formula_candidates(lines, {}), lines)
+
+            small = create_sale(company, carrier, [1])
+            large = create_sale(company, carrier, [20])
+            for criteria, prices in [
+                    ('weight', [Decimal(2), Decimal(1)]),
+                    ('total_amount', [Decimal(4), Decimal(3)]),
+                    ]:
+                with patch.object(Carrier, 'get_formula_pattern',
+                        return_value={'tier_field': criteria}):
+                    self.assertEqual(
+                        Carrier.compute_formula_prices(
+                            [carrier], Sale.browse([small.id, large.id])),
+                        [prices])
+
+    @with_transaction()
+    def test_requote_formula_shipment_costs(self):
+        "Test requote of the draft sales with a shipment cost by the queue"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+        Queue = pool.get('ir.queue')
+
+        def cost_lines(sale):
+            return [l for l in Sale(sale.id).lines
+                if l.shipment_cost is not None]
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(
+                company, [(100, Decimal(5)), (0, Decimal(10))])
+            sales = [create_sale(company, carrier, [q]) for q in [1, 2, 20]]
+            for sale in sales:
+                sale.set_shipment_cost()
+            Sale.save(sales)
+            unquoted = create_sale(company, carrier, [1])
+            self.assertEqual(
+                [l.unit_price for s in sales for l in cost_lines(s)],
+                [Decimal(10), Decimal(10), Decimal(5)])
+            first_line, = cost_lines(sales[0])
+
+            # The total of the first sale crosses the threshold
+            line, = [l for l in sales[0].lines if l.shipment_cost is None]
+            Line.write([line], {'quantity': 11})
+
+            with patch(
+                    'trytond.modules.carrier_formula.sale._requote_chunk', 2):
+                Sale.requote_formula_shipment_costs()
+            tasks = [t.data for t in Queue.search([], order=[('id', 'ASC')])
+                if t.data['method'] == 'requote_formula_shipment_cost']
+            self.assertEqual([list(t['instances']) for t in tasks],
+                [[sales[0].id, sales[1].id], [sales[2].id]])
+
+            for task in tasks:
+                Sale.requote_formula_shipment_cost(
+                    Sale.browse(task['instances']))
+            self.assertEqual(
+                [l.unit_price for s in sales for l in cost_lines(s)],
+                [Decimal(5), Decimal(10), Decimal(5)])
+            self.assertFalse(Line.search([('id', '=', first_line.id)]))
+            self.assertFalse(cost_lines(unquoted))
+
+    @with_transaction()
+    def test_get_sale_price_formula_prices(self):
+        "Test sale price reuses the prices quoted by a batch"
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [(0, Decimal(10))])
+            sale = create_sale(company, carrier, [1])
+            with Transaction().set_context(
+                    sale._get_carrier_context(carrier),
+                    formula_prices={(carrier.id, str(sale)): Decimal(42)}):
+                self.assertEqual(carrier.get_sale_price(),
+                    (Decimal(42), company.currency.id))
+
+    @with_transaction()
+    def test_formula_fields(self):
+        "Test record fields read by the formulas of the lines"
+        pool = Pool()
+        PriceList = pool.get('carrier.formula_price_list')
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [(0, Decimal(5))])
+            line, = carrier.formula_price_list
+            self.assertEqual(line.get_formula_fields(), {'total_amount'})
+
+            PriceList.write([line], {'formula': 'True'})
+            self.assertEqual(
+                PriceList(line.id).get_formula_fields(), frozenset())
+
+            PriceList.write([line], {'formula': 'totals.weight > 1'})
+            self.assertIsNone(PriceList(line.id).get_formula_fields())
+
+    @with_transaction()
+    def test_export_formula_snapshot_criteria(self):
+        "Test export of snapshot with match criteria"
+        pool = Pool()
+        PriceList = pool.get('carrier.formula_price_list')
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [(0, Decimal(5))])
+            line, = carrier.formula_price_list
+            with patch.object(PriceList, 'get_match_criteria',
+                    return_value={'tier_field'}):
+                snapshot = carrier.export_formula_snapshot()
+                self.assertEqual(len(snapshot['lines']), 1)
+
+                PriceList.write([line], {'tier_field': 'weight'})
+                with self.assertRaises(FormulaSnapshotError):
+                    carrier.export_formula_snapshot()
+
+    @with_transaction()
+    def test_check_tier_field(self):
+        "Test check of the tier field"
+        pool = Pool()
+        PriceList = pool.get('carrier.formula_price_list')
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [(0, Decimal(5))])
+            line, = carrier.formula_price_list
+            for tier_field in ['weight', 'totals.weight']:
+                PriceList.write([line], {
+                        'price_type': 'tiers',
+                        'tier_field': tier_field,
+                        })
+            for tier_field in [
+                    None, 'total amount', '_values', 'totals.wieght',
+                    'sale.weight', 'totals.weight.unit']:
+                with self.assertRaises(FormulaValidationError,
+                        msg=tier_field):
+                    PriceList.write([line], {'tier_field': tier_field})
+
+    @with_transaction()
+    def test_get_unit_price(self):
+        "Test unit price of price list lines"
+        pool = Pool()
+        PriceList = pool.get('carrier.formula_price_list')
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [(0, Decimal(5))])
+            line, = carrier.formula_price_list
+            evaluator = FormulaEvaluator(names={
+                    'record': FormulaRecord('sale.sale', {'weight': 2}),
+                    }, functions=FUNCTIONS)
+            self.assertEqual(line.get_unit_price(), Decimal(5))
+            self.assertEqual(line.get_unit_price(evaluator), Decimal(5))
+
+            PriceList.write([line], {
+                    'price_type': 'formula',
+                    'price_formula': 'record.weight * 2',
+                    })
+            line = PriceList(line.id)
+            self.assertEqual(line.get_unit_price(), Decimal(5))
+            self.assertEqual(line.get_unit_price(evaluator), Decimal(4))
+
+            PriceList.write([line], {'price_formula': 'record.weight > 1'})
+            line = PriceList(line.id)
+            with self.assertRaises(FormulaPriceError):
+                line.get_unit_price(evaluator)
+
+    @with_transaction()
+    def test_get_sale_prices(self):
+        "Test sale prices of many carriers for a cart"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Sale = pool.get('sale.sale')
+
+        self.assertIn('get_sale_prices', Carrier.__rpc__)
+        company = create_company()
+        currency_id = company.currency.id
+        with set_company(company):
+            carriers = [
+                create_carrier(company, [(100, Decimal(5)), (0, Decimal(10))]),
+                create_carrier(company, [(50, Decimal(7)), (0, Decimal(9))]),
+                create_carrier(company, [(0, Decimal(1))],
+                    carrier_cost_method='product'),
+                ]
+            for amount, prices in [
+                    (Decimal(20), [Decimal(10), Decimal(9), Decimal(3)]),
+                    (Decimal(200), [Decimal(5), Decimal(7), Decimal(3)]),
+                    ]:
+                cart = {'total_amount': amount}
+                with self.subTest(amount=amount):
+                    result = Carrier.get_sale_prices(carriers, cart)
+                    self.assertEqual(
+                        result, [(p, currency_id) for p in prices])
+                    for carrier, price in zip(carriers, result):
+                        with Transaction().set_context(
+                                carrier=carrier.id, record=cart,
+                                record_model='sale.sale'):
+                            self.assertEqual(carrier.get_sale_price(), price)
+
+            records = [Sale(total_amount=Decimal(v)) for v in [20, 200]]
+            self.assertEqual(
+                Carrier.compute_formula_prices(carriers[:2], records),
+                [[Decimal(10), Decimal(5)], [Decimal(9), Decimal(7)]])
+
+    @with_transaction()
+    def test_get_purchase_prices(self):
+        "Test purchase prices of many purchases"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Party = pool.get('party.party')
+        try:
+            Purchase = pool.get('purchase.purchase')
+        except KeyError:
+            self.skipTest("purchase is not activated")
+        if 'carrier' not in Purchase._fields:
+            self.skipTest("purchase has no carrier")
+
+        company = create_company()
+        with set_company(company):
+            carriers = [
+                create_carrier(company, [(100, Decimal(5)), (0, Decimal(10))]),
+                create_carrier(company, [(50, Decimal(7)), (0, Decimal(9))]),
+                ]
+            party, = Party.create([{'name': 'Supplier'}])
+            purchases = Purchase.create([{
+                        'party': party.id,
+                        'company': company.id,
+                        'currency': company.currency.id,
+                        'carrier': carrier.id if carrier else None,
+                        'lines': [('create', [{
+                                        'type': 'line',
+                                        'description': 'Line',
+                                        'quantity': quantity,
+                                        'unit_price': Decimal(10),
+                                        }])],
+                        } for carrier, quantity in [
+                        (carriers[0], 2), (carriers[0], 20),
+                        (carriers[1], 2), (None, 2)]])
+
+            result = Carrier.get_purchase_prices(Purchase.browse(purchases))
+            self.assertEqual(result, [
+                    (Decimal(10), company.currency.id),
+                    (Decimal(5), company.currency.id),
+                    (Decimal(9), company.currency.id),
+                    None])
+            for purchase, price in zip(purchases[:3], result):
+                with Transaction().set_context(record=str(purchase)):
+                    self.assertEqual(
+                        purchase.carrier.get_purchase_price(), price)
+
+    @with_transaction()
+    def test_formula_line_totals_stored_sale(self):
+        "Test formulas reading the line totals of a stored sale"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        currency_id = company.currency.id
+        with set_company(company):
+            product = create_product(weight=2)
+            sale = create_sale(company, None, [2, 4], product=product)
+
+            totals = Carrier.get_formula_line_totals(Sale(sale.id))
+            self.assertEqual(totals['line_count'], 2)
+            self.assertEqual(totals['quantity'], Decimal(6))
+            self.assertEqual(totals['amount'], Decimal(60))
+            self.assertEqual(totals['weight'], Decimal(12))
+
+            for formula, prices, price in [
+                    ('totals.amount > %s',
+                        [(50, Decimal(8)), (0, Decimal(4))], Decimal(8)),
+                    ('totals.weight > %s',
+                        [(20, Decimal(20)), (0, Decimal(5))], Decimal(5)),
+                    ]:
+                with self.subTest(formula=formula):
+                    carrier = create_carrier(company, prices, formula)
+                    sale = Sale(sale.id)
+                    sale.carrier = carrier
+                    sale.save()
+                    sale = Sale(sale.id)
+                    with Transaction().set_context(
+                            sale._get_carrier_context(carrier)):
+                        self.assertEqual(
+                            carrier.get_sale_price(), (price, currency_id))
+
+    @with_transaction()
+    def test_formula_line_totals_shared(self):
+        "Test line totals of a record are shared by the carriers"
+        pool = Pool()
+        Carrier = pool.get('carrier')
+        Sale = pool.get('sale.sale')
+
+        company = create_company()
+        with set_company(company):
+            carriers = [
+                create_carrier(
+                    company, [(5, Decimal(5))], 'totals.amount > %s'),
+                create_carrier(
+                    company, [(50, Decimal(7)), (0, Decimal(9))],
+                    'totals.amount > %s'),
+                ]
+            sale = create_sale(company, None, [2])
+            with patch.object(Carrier, 'get_formula_line_totals',
+                    wraps=Carrier.get_formula_line_totals) as line_totals:
+                self.assertEqual(
+                    Carrier.compute_formula_prices(carriers, [Sale(sale.id)]),
+                    [[Decimal(5)], [Decimal(9)]])
+                self.assertEqual(line_totals.call_count, 1)
+
+    @with_transaction()
+    def test_formula_shipment_band(self):
+        "Test shipment cost is kept while the inputs stay in their band"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+
+        def cost_line(sale):
+            line, = [l for l in sale.lines if l.shipment_cost is not None]
+            return line
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(
+                company, [(100, Decimal(5)), (0, Decimal(10))])
+            sale = create_sale(company, carrier, [1])
+            sale.set_shipment_cost()
+            sale.save()
+            sale = Sale(sale.id)
+            self.assertTrue(sale.formula_shipment_band)
+            first_cost = cost_line(sale)
+            self.assertEqual(first_cost.unit_price, Decimal(10))
+            line, = [l for l in sale.lines if l.shipment_cost is None]
+
+            Line.write([line], {'quantity': 5})
+            sale = Sale(sale.id)
+            self.assertEqual(sale.set_shipment_cost(), [])
+            self.assertEqual(cost_line(sale), first_cost)
+
+            Line.write([line], {'quantity': 20})
+            sale = Sale(sale.id)
+            removed = sale.set_shipment_cost()
+            self.assertEqual(removed, [first_cost])
+            Line.delete(removed)
+            sale.save()
+            self.assertEqual(cost_line(Sale(sale.id)).unit_price, Decimal(5))
+
+    @with_transaction()
+    def test_formula_shipment_band_tiers(self):
+        "Test shipment cost is requoted after a change of the tiers"
+        pool = Pool()
+        Sale = pool.get('sale.sale')
+        Line = pool.get('sale.line')
+        PriceList = pool.get('carrier.formula_price_list')
+        Tier = pool.get('carrier.formula_price_list.tier')
+
+        def cost_line(sale):
+            line, = [l for l in sale.lines if l.shipment_cost is not None]
+            return line
+
+        company = create_company()
+        with set_company(company):
+            carrier = create_carrier(company, [(0, Decimal(5))])
+            price_line, = carrier.formula_price_list
+            PriceList.write([price_line], {
+                    'price_type': 'tiers',
+                    'tier_field': 'total_amount',
+                    'tiers': [('create', [{
+                                    'start': Decimal(0),
+                                    'rate': Decimal(1),
+                                    }])],
+                    })
+            sale = create_sale(company, carrier, [1])
+            sale.set_shipment_cost()
+            sale.save()
+            sale = Sale(sale.id)
+            first_cost = cost_line(sale)
+            self.assertEqual(first_cost.unit_price, Decimal(15))
+
+            tier, = PriceList(price_line.id).tiers
+            Tier.write([tier], {'rate': Decimal(2)})
+            sale = Sale(sale.id)
+            removed = sale.set_shipment_cost()
+            self.assertEqual(removed, [first_cost])
+            Line.delete(removed)
+            sale.save()
+            self.assertEqual(cost_line(Sale(sale.id)).unit_price, Decimal(25))
 
 
 del ModuleTestCase
@@ -120,9 +120,9 @@ class Test(unittest.TestCase):
         carrier.carrier_cost_method = 'formula'
         carrier.formula_currency = currency
         for sequence, formula, price in (
-            (10, 'sale.total_amount > 100', Decimal(25)),
-            (10, 'sale.total_amount > 50', Decimal(10)),
-            (10, 'sale.total_amount > 0', Decimal(5)),
+            (10, 'record.total_amount > 100', Decimal(25)),
+            (10, 'record.total_amount > 50', Decimal(10)),
+            (10, 'record.total_amount > 0', Decimal(5)),
         ):
 
             line = FormulaPriceList(sequence=sequence,
@@ -0,0 +1,79 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from decimal import Decimal
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+
+from trytond.cache import LRUDictTransaction
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['transaction_cache', 'quantizer', 'company_currency',
+    'currency_digits', 'convert']
+_size = config.getint('cache', 'carrier_formula.transaction', default=1024)
+_caches = WeakKeyDictionary()
+
+
+def transaction_cache(name):
+    """Return the cache name of the current transaction
+
+    It is cleared when a record is modified by the transaction."""
+    transaction = Transaction()
+    caches = _caches.get(transaction)
+    if caches is None:
+        caches = _caches[transaction] = {}
+    cache = caches.get(name)
+    if cache is None:
+        cache = caches[name] = LRUDictTransaction(_size)
+    cache.refresh()
+    return cache
+
+
+@lru_cache(maxsize=32)
+def quantizer(digits):
+    "Return the exponent to quantize to digits"
+    return Decimal(10) ** -Decimal(digits)
+
+
+def company_currency(company_id):
+    "Return the currency id of the company id"
+    pool = Pool()
+    Company = pool.get('company.company')
+    cache = transaction_cache('company_currency')
+    if company_id not in cache:
+        cache[company_id] = Company(company_id).currency.id
+    return cache[company_id]
+
+
+def currency_digits(currency_id):
+    "Return the digits of the currency id"
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    cache = transaction_cache('currency_digits')
+    if currency_id not in cache:
+        cache[currency_id] = Currency(currency_id).digits
+    return cache[currency_id]
+
+
+def convert(from_currency_id, amount, to_currency_id):
+    """Return the amount converted without rounding between the currency ids
+    at the rate of the date of the context"""
+    pool = Pool()
+    Currency = pool.get('currency.currency')
+    if from_currency_id == to_currency_id:
+        return amount
+    cache = transaction_cache('currency_rate')
+    key = (from_currency_id, to_currency_id,
+        Transaction().context.get('date'))
+    if key not in cache:
+        from_currency = Currency(from_currency_id)
+        to_currency = Currency(to_currency_id)
+        if not from_currency.rate or not to_currency.rate:
+            # Let compute raise the missing rate error
+            return Currency.compute(
+                from_currency, amount, to_currency, round=False)
+        cache[key] = (to_currency.rate, from_currency.rate)
+    to_rate, from_rate = cache[key]
+    return amount * to_rate / from_rate
@@ -0,0 +1,193 @@
+# This file is part carrier_formula module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""Evaluation of the formulas over columns of record values
+
+The columns are keyed by the record field name or by the dotted path for
+the other names like "totals.weight". With NumPy, the comparisons,
+boolean and arithmetic operations of a formula are evaluated over the
+whole column at once; the other formulas and the installations without
+NumPy are evaluated row by row with the same result."""
+import ast
+import operator
+from decimal import Decimal
+
+from .formula import (compile_formula, parse_expression, evaluator_class,
+    FormulaRecord, FUNCTIONS, _number, _operand)
+
+__all__ = ['first_match', 'column_rows']
+_COMPARE = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    }
+_BINARY = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    }
+
+
+# NumPy is imported by the first evaluation
+numpy = None
+_numpy_imported = False
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def _import_numpy():
+    "Import NumPy if installed"
+    global numpy, _numpy_imported
+    if not _numpy_imported:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy_imported = True
+    return numpy
+
+
+def column_rows(columns, size, model='sale.sale'):
+    "Return the names of each row of the columns"
+    names = {}
+    for key, column in columns.items():
+        name, _, attr = key.rpartition('.')
+        names.setdefault(name or 'record', {})[attr] = column
+    rows = []
+    for i in range(size):
+        row = {}
+        for name, values in names.items():
+            row[name] = FormulaRecord(
+                model if name == 'record' else name,
+                {k: v[i] for k, v in values.items()})
+        rows.append(row)
+    return rows
+
+
+def _python(array, value):
+    "Return array with Python values if value is a Decimal"
+    # Compare and compute with Decimal like Python does
+    if (isinstance(array, numpy.ndarray) and array.dtype.kind != 'O'
+            and isinstance(value, Decimal)):
+        return array.astype(object)
+    return array
+
+
+def _evaluate(node, columns, functions):
+    "Return the array or the constant value of node"
+    if isinstance(node, ast.Expr):
+        return _evaluate(node.value, columns, functions)
+    number = _number(node)
+    if number is not None:
+        return number
+    path = _operand(node)
+    if path is not None and len(path) == 2:
+        key = path[1] if path[0] == 'record' else '.'.join(path)
+        try:
+            return columns[key]
+        except KeyError:
+            raise _Unsupported
+    if isinstance(node, ast.Constant) and isinstance(node.value, bool):
+        return node.value
+    elif isinstance(node, ast.Compare):
+        left = _evaluate(node.left, columns, functions)
+        result = True
+        for op, comparator in zip(node.ops, node.comparators):
+            if type(op) not in _COMPARE:
+                raise _Unsupported
+            right = _evaluate(comparator, columns, functions)
+            result = numpy.logical_and(
+                result, _truth(_apply(_COMPARE[type(op)], left, right)))
+            left = right
+        return result
+    elif isinstance(node, ast.BoolOp):
+        values = [_truth(_evaluate(v, columns, functions))
+            for v in node.values]
+        if isinstance(node.op, ast.And):
+            return numpy.logical_and.reduce(values)
+        return numpy.logical_or.reduce(values)
+    elif isinstance(node, ast.UnaryOp):
+        value = _evaluate(node.operand, columns, functions)
+        if isinstance(node.op, ast.Not):
+            return numpy.logical_not(_truth(value))
+        elif isinstance(node.op, ast.USub):
+            return -value
+        elif isinstance(node.op, ast.UAdd):
+            return value
+    elif (isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id in functions
+            and not node.keywords):
+        # Call the function on each value
+        args = [_evaluate(a, columns, functions) for a in node.args]
+        function = numpy.frompyfunc(functions[node.func.id], len(args), 1)
+        return function(*args)
+    elif isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+        return _apply(_BINARY[type(node.op)],
+            _evaluate(node.left, columns, functions),
+            _evaluate(node.right, columns, functions))
+    raise _Unsupported
+
+
+def _apply(function, left, right):
+    return function(_python(left, right), _python(right, left))
+
+
+def _truth(value):
+    if isinstance(value, numpy.ndarray):
+        return value.astype(bool)
+    return bool(value)
+
+
+def _evaluate_rows(expression, rows, functions):
+    Evaluator = evaluator_class()
+    return [bool(Evaluator(names=row, functions=functions).evaluate(
+                expression)) for row in rows]
+
+
+def first_match(formulas, columns, size, functions=None):
+    """Return the position of the first true formula for each row of the
+    columns or None
+
+    The formulas are evaluated in sequence only on the rows not yet matched
+    like compute_formula_price."""
+    if functions is None:
+        functions = FUNCTIONS
+    _import_numpy()
+    positions = [None] * size
+    remaining = list(range(size))
+    if numpy is not None:
+        arrays = {k: numpy.asarray(v) for k, v in columns.items()}
+    for position, formula in enumerate(formulas):
+        if not remaining:
+            break
+        expression = compile_formula(formula or '')
+        matches = None
+        if numpy is not None:
+            index = numpy.asarray(remaining)
+            try:
+                matches = _evaluate(parse_expression(expression),
+                    {k: v[index] for k, v in arrays.items()}, functions)
+            except (_Unsupported, TypeError, SyntaxError):
+                matches = None
+            else:
+                matches = numpy.broadcast_to(
+                    _truth(matches), index.shape).tolist()
+        if matches is None:
+            rows = column_rows(
+                {k: [v[i] for i in remaining] for k, v in columns.items()},
+                len(remaining))
+            matches = _evaluate_rows(expression, rows, functions)
+        unmatched = []
+        for i, match in zip(remaining, matches):
+            if match:
+                positions[i] = position
+            else:
+                unmatched.append(i)
+        remaining = unmatched
+    return positions